@@ -0,0 +1,399 @@
+"""
+Raphael Pithan
+2021
+"""
+
+import io
+import os
+import json
+import asyncio
+import mimetypes
+import threading
+import aiohttp
+from google.auth.transport.requests import Request
+
+from auxiliar import *
+from drive import FOLDER_TYPE_FILTER, NOT_FOLDER_TYPE_FILTER, MAX_PAGE_SIZE, \
+    MULTIPART_MAX_SIZE, ChunkSizeController, eprint
+from rate_limiter import is_rate_limit_error, retry_delay
+from metadata_cache import LISTING_DIRS, LISTING_FILES, FOLDER_MIME_TYPE, parse_file_fields
+
+API_URL = 'https://www.googleapis.com/drive/v3'
+UPLOAD_URL = 'https://www.googleapis.com/upload/drive/v3/files'
+ASYNC_MAX_CONCURRENCY = 100 # requests in flight at once
+ASYNC_MAX_RETRIES = 5
+MULTIPART_BOUNDARY = '-------314159265358979323846'
+
+"""
+Error response of the Drive API.
+"""
+class AsyncDriveError(Exception):
+    def __init__(self, status, content):
+        super().__init__('HTTP %d: %s' % (status, content[:500].decode(errors='replace')))
+        self.status = status
+        self.content = content
+
+"""
+Asyncio counterpart of Drive, built on aiohttp. Hundreds of operations can run
+concurrently on a single thread and a single connection pool, instead of one
+duplicate_service() per thread. It shares the credentials, cache and folder
+index of the (connected) Drive it's made from.
+Use as an async context manager, or call open() and close().
+"""
+class AsyncDrive:
+    def __init__(self, drive, concurrency=ASYNC_MAX_CONCURRENCY):
+        self.drive = drive
+        self.concurrency = concurrency
+        self.api_url = drive.root_url + 'drive/v3' if drive.root_url else API_URL
+        self.upload_url = drive.root_url + 'upload/drive/v3/files' if drive.root_url else UPLOAD_URL
+        self.session = None
+        self.semaphore = None
+        self.auth_lock = None
+        self.path_lock = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def open(self):
+        self.session = aiohttp.ClientSession()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.auth_lock = asyncio.Lock()
+        self.path_lock = asyncio.Lock()
+
+    async def close(self):
+        await self.session.close()
+
+    """
+    Get the authorization header, refreshing the credentials if needed.
+    """
+    async def _auth_header(self):
+        credentials = self.drive.credentials
+        if not credentials.valid:
+            async with self.auth_lock:
+                if not credentials.valid:
+                    await asyncio.get_running_loop().run_in_executor(None,
+                        credentials.refresh, Request())
+        return { 'Authorization': 'Bearer ' + credentials.token }
+
+    """
+    Wait for the rate limiter (shared with the Drive instances).
+    """
+    async def _throttle(self):
+        delay = self.drive.rate_limiter.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    """
+    Decide if a failed request is worth retrying, backing off as needed: quota
+    errors pause every request through the rate limiter, server errors only
+    this one.
+    """
+    async def _backoff(self, retry, status, headers, content):
+        if retry >= ASYNC_MAX_RETRIES:
+            return False
+        if is_rate_limit_error(status, content):
+            self.drive.rate_limiter.throttled(retry_delay(retry, headers.get('Retry-After')))
+            return True
+        if status >= 500:
+            await asyncio.sleep(retry_delay(retry))
+            return True
+        return False
+
+    """
+    Make a request, retrying with backoff on rate limit and server errors.
+    Returns the status, the response headers and the content.
+    """
+    async def _request(self, method, url, params=None, body=None, data=None, headers=None):
+        for retry in range(ASYNC_MAX_RETRIES + 1):
+            await self._throttle()
+            async with self.semaphore:
+                all_headers = await self._auth_header()
+                all_headers.update(headers or {})
+                async with self.session.request(method, url, params=params, json=body,
+                        data=data, headers=all_headers, allow_redirects=False) as response:
+                    content = await response.read()
+                    status = response.status
+                    response_headers = response.headers
+            if status < 400:
+                self.drive.rate_limiter.succeeded()
+                return status, response_headers, content
+            if await self._backoff(retry, status, response_headers, content):
+                continue
+            raise AsyncDriveError(status, content)
+
+    async def _request_json(self, method, url, **kwargs):
+        status, headers, content = await self._request(method, url, **kwargs)
+        return json.loads(content) if content else {}
+
+    """
+    Execute a file list request and get all pages of it.
+    """
+    async def _files_list_all_pages(self, **params):
+        fields = params['fields']
+        if fields.find('nextPageToken') == -1 and fields != '*':
+            params['fields'] = 'nextPageToken, ' + fields
+        params = { k: str(v) for k, v in params.items() }
+        all_files = []
+        while True:
+            results = await self._request_json('GET', self.api_url + '/files', params=params)
+            all_files.extend(safe_get_field(results, 'files') or [])
+            pageToken = safe_get_field(results, 'nextPageToken')
+            if not pageToken:
+                return all_files
+            params['pageToken'] = pageToken
+
+    """
+    List all files of a directory.
+    Returns list of dicts with 'id' and 'name'.
+    """
+    async def list_files(self, root_id, query=None, fields='id, name', order='name'):
+        debug_trace(root_id)
+        cache = self.drive.cache
+        cache_fields = parse_file_fields(fields) if cache and not query and order == 'name' else None
+        if cache_fields:
+            results = cache.get_listing(root_id, LISTING_FILES, cache_fields)
+            if results is not None:
+                return results
+        results = await self._files_list_all_pages(
+            q=self.drive._build_query(NOT_FOLDER_TYPE_FILTER, self.drive._parent_filter(root_id), query),
+            fields='files('+fields+')',
+            pageSize=MAX_PAGE_SIZE, orderBy=order)
+        if cache_fields:
+            cache.set_listing(root_id, LISTING_FILES, results, cache_fields)
+        return results
+
+    """
+    List all subdirectories of a directory.
+    Returns list of dicts with 'id' and 'name'.
+    """
+    async def list_subdirs(self, root_id):
+        debug_trace(root_id)
+        index = self.drive.folder_index
+        if index and index.contains(root_id):
+            return index.list_subdirs(root_id)
+        cache = self.drive.cache
+        if cache:
+            results = cache.get_listing(root_id, LISTING_DIRS)
+            if results is not None:
+                return results
+        results = await self._files_list_all_pages(
+            q=self.drive._build_query(FOLDER_TYPE_FILTER, self.drive._parent_filter(root_id)),
+            fields='files(id, name)',
+            pageSize=MAX_PAGE_SIZE, orderBy='name')
+        if cache:
+            cache.set_listing(root_id, LISTING_DIRS, results)
+        return results
+
+    """
+    List all subdirectories and all files of a directory in a single query.
+    Returns a tuple of lists of dicts with 'id' and 'name'.
+    """
+    async def list_subdirs_and_files(self, root_id):
+        debug_trace(root_id)
+        results = await self._files_list_all_pages(
+            q=self.drive._build_query(self.drive._parent_filter(root_id)),
+            fields='files(id, name, mimeType)',
+            pageSize=MAX_PAGE_SIZE, orderBy='name')
+        dirs = []
+        files = []
+        for result in results:
+            is_dir = result.pop('mimeType', None) == FOLDER_MIME_TYPE
+            (dirs if is_dir else files).append(result)
+        return dirs, files
+
+    """
+    Get the id of an immediate subdirectory (or None if it doesn't exist).
+    """
+    async def get_subdir(self, root_id, name):
+        debug_trace(root_id, name)
+        result = await self._request_json('GET', self.api_url + '/files', params={
+            'q': self.drive._build_query(FOLDER_TYPE_FILTER, self.drive._parent_filter(root_id),
+                self.drive._name_filter(name)),
+            'fields': 'files(id)' })
+        return safe_get_field(result, 'files', 0, 'id')
+
+    """
+    Make a directory. Flag check_exists prevents directory duplication (yes, it
+    duplicates), but also adds overhead.
+    Returns the directory id.
+    """
+    async def mkdir(self, root_id, name, check_exists=True):
+        debug_trace(root_id, name, check_exists)
+        id = await self.get_subdir(root_id, name) if check_exists else None
+        if not id:
+            result = await self._request_json('POST', self.api_url + '/files',
+                params={ 'fields': 'id' },
+                body={ 'name': name, 'parents': [ root_id ], 'mimeType': FOLDER_MIME_TYPE })
+            id = result['id']
+        if self.drive.cache:
+            self.drive.cache.add_folder(id, root_id, name)
+        if self.drive.folder_index:
+            self.drive.folder_index.add(id, root_id, name)
+        return id
+
+    """
+    Get the id of an immediate subdirectory from the folder index or the cache,
+    or else from the API (or None if it doesn't exist).
+    """
+    async def _lookup_subdir(self, root_id, name):
+        index = self.drive.folder_index
+        if index and index.contains(root_id):
+            return index.get_subdir(root_id, name)
+        sub = self.drive.cache.get_subdir(root_id, name) if self.drive.cache else None
+        if not sub:
+            sub = await self.get_subdir(root_id, name)
+            if sub and self.drive.cache:
+                self.drive.cache.add_folder(sub, root_id, name)
+        return sub
+
+    """
+    Get the id of a nested subdirectory (or None if it doesn't exist).
+    """
+    async def get_subpath(self, root_id, path, create=False):
+        debug_trace(root_id, path, create)
+        current_root = root_id
+        for dir in filter(None, path.split('/')):
+            sub = await self._lookup_subdir(current_root, dir)
+            if not sub:
+                if not create:
+                    return None
+                async with self.path_lock: # another task may have just created it
+                    sub = await self._lookup_subdir(current_root, dir) or \
+                        await self.mkdir(current_root, dir, check_exists=False)
+            current_root = sub
+        return current_root
+
+    """
+    Download a file (by id), streaming it into output_file.
+    Returns the file.
+    """
+    async def download_file(self, file_id, output_file=None, progress_callback=None):
+        debug_trace(file_id)
+        file = io.BytesIO() if output_file == None else output_file
+        for retry in range(ASYNC_MAX_RETRIES + 1):
+            await self._throttle()
+            async with self.semaphore:
+                headers = await self._auth_header()
+                async with self.session.get(self.api_url + '/files/' + file_id,
+                        params={ 'alt': 'media' }, headers=headers) as response:
+                    if response.status < 400:
+                        self.drive.rate_limiter.succeeded()
+                        total = response.content_length or 0
+                        progress = 0
+                        if progress_callback:
+                            progress_callback(0, 0) # shows empty at first
+                        async for data in response.content.iter_chunked(1024*1024):
+                            file.write(data)
+                            progress += len(data)
+                            if progress_callback:
+                                progress_callback(progress, total)
+                        file.seek(0)
+                        return file
+                    status = response.status
+                    response_headers = response.headers
+                    content = await response.read()
+            if await self._backoff(retry, status, response_headers, content):
+                continue
+            raise AsyncDriveError(status, content)
+
+    """
+    Upload a file to a given directory (by id). Flag check_exists prevents file
+    duplication (yes, it duplicates), but also adds overhead. Small files go in
+    a single multipart request, the others through a resumable session.
+    Returns the file id.
+    """
+    async def upload_file(self, root_id, full_file_path, progress_callback=None, check_exists=True, replace=False):
+        debug_trace(root_id, full_file_path, check_exists, replace)
+        file_name = extract_file_name(full_file_path)
+        mimetype = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+
+        if check_exists or replace:
+            existing_files = await self.list_files(root_id,
+                query=self.drive._name_filter(file_name))
+            if len(existing_files) > 0:
+                if not replace:
+                    return safe_get_field(existing_files, 0, 'id')
+                for file in existing_files:
+                    eprint('INFO: deleting a file, ' + str(file['id']) + ' ' + file_name)
+                await asyncio.gather(*[ self._request('DELETE', self.api_url + '/files/' + file['id'])
+                    for file in existing_files ])
+                if self.drive.cache:
+                    for file in existing_files:
+                        self.drive.cache.remove(file['id'])
+
+        body = { 'name': file_name, 'parents': [ root_id ], 'mimeType': mimetype }
+        loop = asyncio.get_running_loop()
+        if progress_callback:
+            progress_callback(0, 0) # shows empty at first
+        with open(full_file_path, 'rb') as file:
+            file_size = os.fstat(file.fileno()).st_size
+            if file_size <= MULTIPART_MAX_SIZE:
+                content = await loop.run_in_executor(None, file.read)
+                data = b''.join([
+                    ('--%s\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n' % MULTIPART_BOUNDARY).encode(),
+                    json.dumps(body).encode(),
+                    ('\r\n--%s\r\nContent-Type: %s\r\n\r\n' % (MULTIPART_BOUNDARY, mimetype)).encode(),
+                    content,
+                    ('\r\n--%s--' % MULTIPART_BOUNDARY).encode() ])
+                result = await self._request_json('POST', self.upload_url,
+                    params={ 'uploadType': 'multipart', 'fields': 'id' }, data=data,
+                    headers={ 'Content-Type': 'multipart/related; boundary=' + MULTIPART_BOUNDARY })
+            else:
+                status, headers, content = await self._request('POST', self.upload_url,
+                    params={ 'uploadType': 'resumable', 'fields': 'id' }, body=body,
+                    headers={ 'X-Upload-Content-Type': mimetype,
+                        'X-Upload-Content-Length': str(file_size) })
+                session_uri = headers['Location']
+                chunks = ChunkSizeController()
+                progress = 0
+                while True:
+                    file.seek(progress)
+                    data = await loop.run_in_executor(None, file.read, chunks.chunk_size)
+                    chunks.start()
+                    status, headers, content = await self._request('PUT', session_uri, data=data,
+                        headers={ 'Content-Range': 'bytes %d-%d/%d' % (progress,
+                            progress + len(data) - 1, file_size) })
+                    if status in [ 200, 201 ]:
+                        result = json.loads(content)
+                        break
+                    previous = progress
+                    progress = int(headers['Range'].split('-')[1]) + 1 if 'Range' in headers else 0
+                    chunks.update(progress - previous)
+                    if progress_callback:
+                        progress_callback(progress, file_size, chunks.chunk_size)
+        if progress_callback:
+            progress_callback(file_size, file_size)
+        if self.drive.cache:
+            self.drive.cache.add_file(result['id'], root_id, file_name, size=file_size)
+        return result['id']
+
+"""
+Event loop running in a background thread, so synchronous code can hand
+coroutines to it (e.g. AsyncDrive operations) and get concurrent futures back.
+"""
+class AsyncRunner:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    """
+    Schedule a coroutine. Returns a concurrent.futures.Future.
+    """
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    """
+    Run a coroutine and wait for its result.
+    """
+    def run(self, coroutine):
+        return self.submit(coroutine).result()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
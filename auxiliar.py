@@ -4,13 +4,16 @@ Raphael Pithan
 """
 
 import os.path
-import inspect
+import sys
+import time
+import atexit
 
 DEBUG_TRACE = 0
 
 # Debug -----------
 
 if DEBUG_TRACE:
+    import inspect
     def debug_trace(*args):
         print('['+inspect.stack()[1].frame.f_code.co_name+']: ', end='')
         print(*args)
@@ -29,6 +32,35 @@ def debug_print_list(lst):
     except:
         pass
 
+# Profiling -------
+
+PROFILE_START_TIME = time.perf_counter()
+g_profile_marks = None # list of (label, time), when profiling the startup
+
+"""
+Start recording the time each startup phase takes (see profile_mark). The
+report is printed to stderr when the program exits.
+"""
+def profile_startup():
+    global g_profile_marks
+    g_profile_marks = [ ('start', PROFILE_START_TIME) ]
+    atexit.register(print_startup_profile)
+
+"""
+Mark the end of a startup phase (when profiling it).
+"""
+def profile_mark(label):
+    if g_profile_marks is not None:
+        g_profile_marks.append((label, time.perf_counter()))
+
+def print_startup_profile():
+    print('\n--Startup profile--', file=sys.stderr)
+    for i in range(1, len(g_profile_marks)):
+        label, mark_time = g_profile_marks[i]
+        print('%8.1f ms %8.1f ms  %s' % ((mark_time - g_profile_marks[i-1][1]) * 1000,
+            (mark_time - PROFILE_START_TIME) * 1000, label), file=sys.stderr)
+    print('%d modules loaded' % len(sys.modules), file=sys.stderr)
+
 # Helper ----------
 
 def safe_get_field(struct, *args):
@@ -0,0 +1,256 @@
+"""
+Program for benchmarking upload.py, checkdups.py and download.py against a
+local fake Drive (see fake_drive_server.py), on standard directory trees.
+Run with --help for more info.
+
+Raphael Pithan
+2021
+"""
+
+import os
+import os.path
+import sys
+import json
+import time
+import shlex
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+from auxiliar import *
+from fake_drive_server import FakeDriveServer
+from pack import is_pack_index, PACK_PREFIX, PACK_SUFFIX, PACK_INDEX_SUFFIX
+
+#===============================================================================
+# Constants
+
+# Configurable ----
+
+# Trees: 'dirs' branches of 'depth' nested directories, each with 'files' files
+# of up to 'size' bytes; the scale multiplies the 'scaled' one
+TREE_SHAPES = {
+    'tiny': { 'dirs': 20, 'depth': 1, 'files': 100, 'size': 4 * 1024, 'scaled': 'files' },
+    'huge': { 'dirs': 1, 'depth': 1, 'files': 3, 'size': 32 * 1024 * 1024, 'scaled': 'size' },
+    'deep': { 'dirs': 4, 'depth': 12, 'files': 4, 'size': 16 * 1024, 'scaled': 'depth' },
+}
+DEFAULT_SHAPES = [ 'tiny', 'huge', 'deep' ]
+DEFAULT_LATENCY = 0.03 # seconds per request, close to Drive's
+DEFAULT_BANDWIDTH = 50 * 1024 * 1024 # bytes per second, per request
+DEFAULT_SEED = 2021
+DEST_ROOT = 'benchmark'
+SECRET_FILE = 'client_secret_benchmark.json' # only found, never read
+
+# Not configurable
+MEGA = 1024 * 1024
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+#===============================================================================
+# Trees
+
+"""
+Create a tree of the given shape in root, with random (but, by the seed,
+always the same) contents.
+Returns (number of files, total size).
+"""
+def make_tree(root, shape, scale, seed):
+    shape = dict(shape)
+    shape[shape['scaled']] = max(1, int(shape[shape['scaled']] * scale))
+    rand = random.Random(seed)
+    total_files = 0
+    total_size = 0
+    for i in range(shape['dirs']):
+        path = os.path.join(root, 'dir%03d' % i)
+        for level in range(shape['depth']):
+            if level > 0:
+                path = os.path.join(path, 'level%02d' % level)
+            os.makedirs(path, exist_ok=True)
+            for j in range(shape['files']):
+                size = rand.randint(shape['size'] // 2, shape['size'])
+                with open(os.path.join(path, 'file%04d.bin' % j), 'wb') as f:
+                    f.write(rand.randbytes(size))
+                total_files += 1
+                total_size += size
+    return total_files, total_size
+
+"""
+Map each file of a tree to its (size, MD5), by relative path. Packs (see
+pack.py) are unpacked: their files are read out of the archive where the index
+says they are, and the archive and index themselves left out.
+"""
+def tree_contents(root):
+    contents = {}
+    for path, dirs, files in os.walk(root):
+        for file in files:
+            full_file_path = os.path.join(path, file)
+            if is_pack_index(file):
+                with open(full_file_path, 'rt') as f:
+                    index = json.load(f)
+                archive_path = full_file_path[:-len(PACK_INDEX_SUFFIX)] + PACK_SUFFIX
+                with open(archive_path, 'rb') as archive:
+                    for name, entry in index['files'].items():
+                        archive.seek(entry['offset'])
+                        data = archive.read(entry['size'])
+                        contents[os.path.relpath(os.path.join(path, name), root)] = (len(data),
+                            hashlib.md5(data).hexdigest())
+            elif not (file.startswith(PACK_PREFIX) and file.endswith(PACK_SUFFIX)):
+                with open(full_file_path, 'rb') as f:
+                    contents[os.path.relpath(full_file_path, root)] = (os.path.getsize(full_file_path),
+                        hashlib.md5(f.read()).hexdigest())
+    return contents
+
+#===============================================================================
+# Benchmark
+
+"""
+Run one of the programs against the fake Drive, with its output in a log.
+Returns (seconds, exit code).
+"""
+def run_step(server, work_dir, log_name, script, args):
+    env = dict(os.environ)
+    env['PYDRIVE_API_ROOT_URL'] = server.url
+    with open(os.path.join(work_dir, log_name), 'wt') as log:
+        start = time.monotonic()
+        result = subprocess.run([ sys.executable, os.path.join(SCRIPTS_DIR, script), *args ],
+            cwd=work_dir, env=env, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+        return time.monotonic() - start, result.returncode
+
+"""
+Benchmark a tree shape on a new fake Drive: upload, upload again (nothing to
+do), check duplicates and download, each one measured on its own.
+Returns list of result dicts.
+"""
+def benchmark_shape(name, work_dir, options):
+    source = os.path.join(work_dir, 'source')
+    output = os.path.join(work_dir, 'output')
+    print('Creating the "%s" tree... ' % name, end='', flush=True)
+    num_files, total_size = make_tree(source, TREE_SHAPES[name], options['scale'], options['seed'])
+    print('%d files (%s)' % (num_files, format_pretty_size(total_size)))
+    with open(os.path.join(work_dir, SECRET_FILE), 'wt') as f:
+        f.write('{}')
+    steps = [
+        ('upload', 'upload.py', [ '--source', source, '--dest', DEST_ROOT, '--skip-confirmation',
+            *options['upload_options'] ], True),
+        ('upload again', 'upload.py', [ '--source', source, '--dest', DEST_ROOT, '--skip-confirmation',
+            *options['upload_options'] ], False),
+        ('checkdups', 'checkdups.py', [ '--dest', DEST_ROOT ], False),
+        ('download', 'download.py', [ '--source', DEST_ROOT, '--dest', output, '--skip-confirmation',
+            *options['download_options'] ], True),
+    ]
+    results = []
+    with FakeDriveServer(latency=options['latency'], bandwidth=options['bandwidth'],
+            error_rate=options['error_rate'], quota=options['quota'], seed=options['seed']) as server:
+        server.drive.make_path(DEST_ROOT)
+        for step, script, args, transfers in steps:
+            print('  %s... ' % step, end='', flush=True)
+            server.reset_stats()
+            log_name = '%s-%s.log' % (name, step.replace(' ', '-'))
+            seconds, exit_code = run_step(server, work_dir, log_name, script, args)
+            stats = server.stats()
+            result = { 'shape': name, 'step': step, 'files': num_files, 'bytes': total_size,
+                'seconds': seconds, 'exit_code': exit_code,
+                'files_per_minute': num_files / seconds * 60,
+                'mb_per_second': total_size / MEGA / seconds if transfers else None,
+                'calls_per_file': stats['calls'] / num_files, **stats }
+            results.append(result)
+            if exit_code != 0:
+                print('FAILED (exit code %d, see %s)' % (exit_code, os.path.join(work_dir, log_name)))
+            else:
+                print('%0.2f s' % seconds)
+    verified = tree_contents(source) == tree_contents(output)
+    if not verified:
+        print('  WARNING: the downloaded tree differs from the uploaded one!')
+    for result in results:
+        result['verified'] = verified
+    return results
+
+"""
+Print the results as a table.
+"""
+def print_results(results):
+    header = '%-6s %-13s %7s %10s %8s %10s %8s %8s %10s %7s' % ('shape', 'step', 'files', 'size',
+        'seconds', 'files/min', 'MB/s', 'calls', 'calls/file', 'errors')
+    print()
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        print('%-6s %-13s %7d %10s %8.2f %10.0f %8s %8d %10.2f %7d%s' % (result['shape'], result['step'],
+            result['files'], format_pretty_size(result['bytes']), result['seconds'],
+            result['files_per_minute'],
+            '%0.1f' % result['mb_per_second'] if result['mb_per_second'] is not None else '-',
+            result['calls'], result['calls_per_file'], result['errors'],
+            ' FAILED' if result['exit_code'] != 0 else ''))
+
+"""
+Main. See script's doc bellow for more information.
+"""
+def main(shapes, options):
+    print('Fake Drive: %0.0f ms latency, %s/s bandwidth, %0.1f%% errors, %s calls/s quota, seed %d' % (
+        options['latency'] * 1000, format_pretty_size(options['bandwidth']) if options['bandwidth'] else 'unlimited',
+        options['error_rate'] * 100, options['quota'] or 'no', options['seed']))
+    results = []
+    for name in shapes:
+        work_dir = tempfile.mkdtemp(prefix='pydrive_benchmark_%s_' % name)
+        try:
+            results.extend(benchmark_shape(name, work_dir, options))
+        finally:
+            if options['keep']:
+                print('  files kept in %s' % work_dir)
+            else:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    print_results(results)
+    if options['json']:
+        with open(options['json'], 'wt') as f:
+            json.dump({ 'options': options, 'results': results }, f, indent=2)
+    if any([ result['exit_code'] != 0 or not result['verified'] for result in results ]):
+        sys.exit(1)
+
+USAGE = """
+python benchmark.py [OPTIONS] [SHAPE ...]
+  Runs upload.py, upload.py again (nothing left to do), checkdups.py and
+download.py on each tree SHAPE ('tiny': lots of small files, 'huge': a few
+large ones, 'deep': deep nesting; default all), against a local fake Drive,
+and reports files/min, MB/s and API calls per file of each step. The
+downloaded tree must be the same as the uploaded one, or the run fails. Same
+options, same results (besides the machine's speed).
+  Options:
+    --scale X Multiply the tree sizes by X (default 1).
+    --latency S Seconds added to each request (default 0.03).
+    --bandwidth B Bytes per second of each request (default 50 MB, 0 for
+unlimited).
+    --error-rate R Share (0 to 1) of the API calls failing with server errors.
+    --quota N API calls per second allowed, more get rate limit errors.
+    --seed N Seed of the tree contents and errors (default 2021).
+    --upload-options="..." More options for upload.py, e.g.
+--upload-options="--async --pack" (with the '=', since they start with '--').
+Packed files are checked too, read out of the downloaded archives.
+    --download-options="..." More options for download.py.
+    --json FILE Save the options and results to FILE, for comparisons.
+    --keep Keep the trees and the programs' logs (temporary directories).
+"""
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage=USAGE)
+    parser.add_argument('shapes', nargs='*')
+    parser.add_argument('--scale', type=float, default=1)
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY)
+    parser.add_argument('--bandwidth', type=float, default=DEFAULT_BANDWIDTH)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--quota', type=int)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--upload-options', default='')
+    parser.add_argument('--download-options', default='')
+    parser.add_argument('--json')
+    parser.add_argument('--keep', action='store_true', default=False)
+    args = parser.parse_args()
+
+    for name in args.shapes:
+        if name not in TREE_SHAPES:
+            print('Unknown tree shape "%s", choose from: %s' % (name, ', '.join(TREE_SHAPES.keys())))
+            sys.exit(1)
+
+    main(args.shapes or DEFAULT_SHAPES, { 'scale': args.scale, 'latency': args.latency,
+        'bandwidth': args.bandwidth or None, 'error_rate': args.error_rate, 'quota': args.quota,
+        'seed': args.seed, 'upload_options': shlex.split(args.upload_options),
+        'download_options': shlex.split(args.download_options), 'json': args.json, 'keep': args.keep })
@@ -6,19 +6,31 @@ Raphael Pithan
 import os
 import sys
 import argparse
-import tkinter as tk
-from tkinter import simpledialog
+import builtins
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+# The Google API and tkinter modules take a while to load, they are imported
+# only when needed
 from auxiliar import *
-from drive import *
 
-f = open('dups.log', 'wt')
+#===============================================================================
+# Constants
+
+CHECK_WORKERS = 8
+
+DUPS_LOG = 'dups.log'
+
+g_log_file = None # opened on the first print
 def print2(*args, **kwargs):
-    __builtins__.print(*args, **kwargs)
+    global g_log_file
+    builtins.print(*args, **kwargs)
+    if g_log_file is None:
+        g_log_file = open(DUPS_LOG, 'wt')
     endl = '\n' if not 'end' in kwargs else kwargs['end']
-    f.write('\t'.join(args))
-    f.write(endl)
+    g_log_file.write('\t'.join(args))
+    g_log_file.write(endl)
 print = print2
 
 #===============================================================================
@@ -38,6 +50,8 @@ g_tk_root = None
 Open a text dialog prompt for typing the name of the destination directory.
 """
 def ask_for_dest(initial):
+    import tkinter as tk
+    from tkinter import simpledialog
     global g_tk_root
     if not g_tk_root:
         g_tk_root = tk.Tk()
@@ -66,8 +80,7 @@ Check directory recursively.
 """
 def check_dir(drive, id, path):
     print('Checking directory ' + path)
-    dirs = drive.list_subdirs(id)
-    files = drive.list_files(id)
+    dirs, files = drive.list_subdirs_and_files(id)
     check_dup(dirs, lambda n: print('** Duplicate directory found: ' + n))
     check_dup(files, lambda n: print('** Duplicate files found: ' + n))
     for dir in dirs:
@@ -78,27 +91,142 @@ def check_dir(drive, id, path):
         else:
             print('** Empty directory id found in ' + path)
 
+"""
+Check directory tree with a pool of workers (each with its own Drive instance),
+which list the directories breadth-first as soon as they're found. Reports are
+printed as the listings arrive, in the same order as check_dir.
+"""
+def check_tree(drive, id, path, num_workers):
+    thread_data = threading.local()
+    def list_dir(id):
+        if not hasattr(thread_data, 'drive'):
+            thread_data.drive = drive.duplicate_service()
+        return thread_data.drive.list_subdirs_and_files(id)
+    with ThreadPoolExecutor(num_workers) as pool:
+        # Pending output in depth-first order: directories being listed, or lines
+        pending = [ (path, pool.submit(list_dir, id)) ]
+        while len(pending) > 0:
+            item = pending.pop()
+            if isinstance(item, str):
+                print(item)
+                continue
+            path, listing = item
+            print('Checking directory ' + path)
+            dirs, files = listing.result()
+            check_dup(dirs, lambda n: print('** Duplicate directory found: ' + n))
+            check_dup(files, lambda n: print('** Duplicate files found: ' + n))
+            subdirs = []
+            for dir in dirs:
+                id = safe_get_field(dir, 'id')
+                name = safe_get_field(dir, 'name') or '<empty>'
+                if id:
+                    subdirs.append((path + '/' + name, pool.submit(list_dir, id)))
+                else:
+                    subdirs.append('** Empty directory id found in ' + path)
+            pending.extend(reversed(subdirs))
+
+"""
+Check a whole tree for files with the same content (size and MD5), wherever
+they are: every file of the Drive is paged through once and grouped by content
+as the pages come. Duplicates are reported as they're found, the totals at the
+end.
+"""
+def check_contents(drive, id, path):
+    print('Indexing directories of ' + path)
+    index = drive.build_folder_index(id)
+    print('%d directories found, checking files' % len(index))
+    contents = {} # (size, md5) -> path of the first file found
+    num_files = 0
+    num_duplicates = 0
+    reclaimable_size = 0
+    duplicate_contents = set()
+    for file in drive.iter_all_files(fields='id, name, size, md5Checksum, parents'):
+        parent = next((p for p in file.get('parents') or [] if index.contains(p)), None)
+        if parent is None or 'md5Checksum' not in file:
+            continue # outside of the tree, or without content (e.g. Google Docs)
+        num_files += 1
+        file_path = clean_path(path + '/' + index.get_path(parent)) + '/' + file['name']
+        content = (int(file.get('size') or 0), file['md5Checksum'])
+        if content in contents:
+            print('** Duplicate content found: %s (same as %s, %s)' % (file_path,
+                contents[content], format_pretty_size(content[0])))
+            num_duplicates += 1
+            reclaimable_size += content[0]
+            duplicate_contents.add(content)
+        else:
+            contents[content] = file_path
+    print('%d file(s) checked, %d duplicate(s) of %d content(s), %s reclaimable' % (num_files,
+        num_duplicates, len(duplicate_contents), format_pretty_size(reclaimable_size)))
+
+"""
+Check directory recursively, with the subdirectories checked concurrently.
+Returns the lines to print, in the same order as check_dir.
+"""
+async def check_dir_async(drive, id, path):
+    import asyncio
+    lines = [ 'Checking directory ' + path ]
+    dirs, files = await drive.list_subdirs_and_files(id)
+    check_dup(dirs, lambda n: lines.append('** Duplicate directory found: ' + n))
+    check_dup(files, lambda n: lines.append('** Duplicate files found: ' + n))
+    checks = []
+    for dir in dirs:
+        id = safe_get_field(dir, 'id')
+        name = safe_get_field(dir, 'name') or '<empty>'
+        if id:
+            checks.append(check_dir_async(drive, id, path + '/' + name))
+        else:
+            checks.append(asyncio.sleep(0, [ '** Empty directory id found in ' + path ]))
+    for sublines in await asyncio.gather(*checks):
+        lines.extend(sublines)
+    return lines
+
+"""
+Check directory recursively through an AsyncDrive (see check_dir_async).
+"""
+async def check_all_async(drive, id, path):
+    from async_drive import AsyncDrive
+    async with AsyncDrive(drive) as async_drive:
+        for line in await check_dir_async(async_drive, id, path):
+            print(line)
+
 """
 Main. See script's doc bellow for more information.
 """
-def main(drive_root):
+def main(drive_root, options):
     print(datetime.now().strftime("%d/%m/%Y %H:%M:%S"))
 
     secret_file = get_client_secret_file()
     if not secret_file:
         print('No client secret file found!')
         sys.exit(1)
+    from drive import Drive
+    profile_mark('Drive modules loaded')
     print('Connecting to Google Drive... ', end='')
     drive = Drive()
     drive.connect(secret_file)
     print('CONNECTED')
+    profile_mark('connected')
 
-    check_dir(drive, drive.get_path(drive_root), drive_root)
+    if options['by_content']:
+        check_contents(drive, drive.get_path(drive_root), drive_root)
+    elif options['async']:
+        import asyncio
+        asyncio.run(check_all_async(drive, drive.get_path(drive_root), drive_root))
+    elif options['workers'] > 1:
+        check_tree(drive, drive.get_path(drive_root), drive_root, options['workers'])
+    else:
+        check_dir(drive, drive.get_path(drive_root), drive_root)
 
 USAGE = """
 python getdups.py [OPTIONS] [--dest drive_root]
   Options:
     --ask-dest Ask for destination (even if dest is specified).
+    --async Check the directories concurrently (needs aiohttp).
+    --by-content Look for files with the same content (size and MD5) anywhere
+in the tree, instead of same-name siblings.
+    --profile-startup Report how long each startup phase took, on exit.
+    --workers N Number of directories listed in parallel (default 8, 1 checks
+them one by one).
   --dest drive_root Destination path on the Drive which will be checked for
 duplicates.
 """
@@ -106,7 +234,14 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(usage=USAGE)
     parser.add_argument('--ask-dest', action='store_true', default=False)
     parser.add_argument('--dest')
+    parser.add_argument('--async', dest='use_async', action='store_true', default=False)
+    parser.add_argument('--workers', type=int, default=CHECK_WORKERS)
+    parser.add_argument('--by-content', action='store_true', default=False)
+    parser.add_argument('--profile-startup', action='store_true', default=False)
     args = parser.parse_args()
+    if args.profile_startup:
+        profile_startup()
+        profile_mark('arguments parsed')
 
     if args.ask_dest or not args.dest:
         args.dest = ask_for_dest(args.dest)
@@ -115,4 +250,4 @@ if __name__ == '__main__':
         print('No destination specified')
         sys.exit(1)
         
-    main(args.dest)
+    main(args.dest, { 'async': args.use_async, 'workers': args.workers, 'by_content': args.by_content })
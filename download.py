@@ -0,0 +1,457 @@
+"""
+Program for downloading (mirroring) a directory tree of Google Drive.
+Run with --help for more info.
+
+Raphael Pithan
+2021
+"""
+
+import os
+import os.path
+import sys
+import time
+import argparse
+import signal
+import builtins
+import threading
+from datetime import datetime
+
+# The Google API, tkinter and hashing modules take a while to load, they are
+# imported only when needed
+from auxiliar import *
+from work_queue import Dispatcher, Worker, SCHEDULE_FIFO, SCHEDULE_POLICIES
+from concurrent_progress_bar import ConcurrentProgressBar as ProgressBar
+
+#===============================================================================
+# Constants
+
+# Configurable ----
+
+MAX_CONCURRENT_DOWNLOADS = 4
+LIST_FILES_GROUP = 25 # directories whose files are listed at once
+SCHEDULE_LOOKAHEAD = 64 # files the scheduling policy chooses from
+LAST_EXECUTION_LOG = 'log/download%s.log'
+HASH_CACHE_FILE = 'cache/hashes.db'
+PARTIAL_FILE_SUFFIX = '.part' # downloads in progress, renamed when done
+SEGMENTED_MIN_SIZE = 256 * 1024 * 1024 # larger files use several connections
+SEGMENT_CONNECTIONS = 4
+
+# Not configurable
+GIGA = 1 * 1024 * 1024 * 1024
+
+# Log -------------
+
+g_log_file = None # opened on the first print
+def print2(*args, **kwargs):
+    global g_log_file
+    builtins.print(*args, **kwargs)
+    if g_log_file is None:
+        os.makedirs(os.path.split(LAST_EXECUTION_LOG)[0], exist_ok=True)
+        g_log_file = open(LAST_EXECUTION_LOG % datetime.now().strftime("%Y%m%d%H%M%S%f"), 'wt')
+    endl = '\n' if not 'end' in kwargs else kwargs['end']
+    g_log_file.write('\t'.join(args))
+    g_log_file.write(endl)
+print = print2
+
+#===============================================================================
+# User interface
+
+"""
+Find the most probable client secret file around.
+"""
+def get_client_secret_file():
+    candidates = [f for f in os.listdir('.') if f.startswith('client_secret')]
+    return safe_get_field(candidates, 0) # ooo, advanced, machine learning, AI logic
+
+# Global
+g_tk_root = None
+
+"""
+Open a text dialog prompt for typing the path of the source directory.
+"""
+def ask_for_source(initial):
+    import tkinter as tk
+    from tkinter import simpledialog
+    global g_tk_root
+    if not g_tk_root:
+        g_tk_root = tk.Tk()
+        g_tk_root.withdraw()
+    return simpledialog.askstring("Source",
+        'Source directory on Google Drive (must exist):',
+        initialvalue=initial)
+
+"""
+Open a file dialog for selecting a directory.
+"""
+def ask_for_dest(initial=None):
+    import tkinter as tk
+    from tkinter import filedialog
+    global g_tk_root
+    if not g_tk_root:
+        g_tk_root = tk.Tk()
+        g_tk_root.withdraw()
+    return filedialog.askdirectory(title='Destination directory to download into',
+        initialdir=initial)
+
+#===============================================================================
+# Main
+
+# Global
+g_stop_loop = False
+g_progress_bar = None
+g_thread_data = []
+
+"""
+Handle Ctrl+C during the main loop.
+"""
+def signal_handler(sig, frame):
+    global g_stop_loop
+    g_stop_loop = True
+    print('Ctrl+C')
+
+"""
+Make a Drive file (or folder) name valid as a local one, a single path
+component.
+Returns None for names that can't be one ('', '.' and '..').
+"""
+def local_file_name(name):
+    if name in [ '', '.', '..' ]:
+        return None
+    return name.replace('/', '_').replace('\\', '_').replace('\0', '_')
+
+"""
+Get the local path of an indexed folder relative to the root, each folder name
+made valid (see local_file_name).
+Returns None if one of them can't be.
+"""
+def local_dir_path(index, id):
+    names = []
+    while id != index.root_id:
+        id, name = index.parents[id]
+        names.append(local_file_name(name))
+        if names[-1] is None:
+            return None
+    return '/'.join(reversed(names))
+
+"""
+Check if a path is in a directory (or is it), once links are resolved.
+"""
+def is_inside(path, dir):
+    dir = os.path.realpath(dir)
+    return os.path.commonpath([ dir, os.path.realpath(path) ]) == dir
+
+"""
+List the files of every directory of the tree, in groups of up to
+LIST_FILES_GROUP directories per round trip. Folders whose names can't be
+local ones are left out, with what's in them.
+Returns list of (relative local path, files) sorted by path, files being dicts
+with 'id', 'name', 'size' and 'md5Checksum'.
+"""
+def list_tree(drive, index):
+    dirs = []
+    for id in [ index.root_id ] + [ folder[0] for folder in index.get_all() ]:
+        path = local_dir_path(index, id)
+        if path is None:
+            print('Folder "%s" not downloaded, its name (or a parent\'s) can\'t be a local one'
+                % index.get_path(id))
+        else:
+            dirs.append((path, id))
+    dirs.sort()
+    tree = []
+    for i in range(0, len(dirs), LIST_FILES_GROUP):
+        group = dirs[i:i+LIST_FILES_GROUP]
+        listings = drive.list_files_multi([ id for path, id in group ],
+            fields='id, name, size, md5Checksum')
+        for path, id in group:
+            tree.append((path, listings[id]))
+    return tree
+
+"""
+Find the files of a directory which already exist locally: same size and, when
+checking by content, same MD5.
+Returns set of local file names.
+"""
+def find_existing_files(local_dir, files, hasher=None):
+    same_size = {}
+    for file in files:
+        if local_file_name(file['name']) is None:
+            continue
+        full_file_path = os.path.join(local_dir, local_file_name(file['name']))
+        if os.path.isfile(full_file_path) and os.path.getsize(full_file_path) == int(file['size']):
+            same_size[full_file_path] = file
+    if not hasher:
+        return set([ os.path.basename(path) for path in same_size ])
+    hashes = hasher.hash_files(list(same_size.keys()))
+    return set([ os.path.basename(path) for path, file in same_size.items()
+        if path in hashes and hashes[path][1] == file['md5Checksum'] ])
+
+"""
+Main. See script's doc bellow for more information.
+"""
+def main(source_root, dest_root, options):
+    # Examine source
+    secret_file = get_client_secret_file()
+    if not secret_file:
+        print('No client secret file found!')
+        sys.exit(1)
+    from drive import Drive
+    profile_mark('Drive modules loaded')
+    print('Connecting to Google Drive... ', end='')
+    drive = Drive()
+    drive.connect(secret_file)
+    print('CONNECTED')
+    profile_mark('connected')
+
+    print('Searching for the source path in your Drive... ', end='')
+    source_root_id = drive.get_path(source_root)
+    if not source_root_id:
+        print('\nERROR: path "%s" not found in your Drive' % source_root)
+        sys.exit(1)
+    print('FOUND (%s)' % source_root_id)
+
+    print('Listing the source files... ', end='')
+    tree = list_tree(drive, drive.build_folder_index(source_root_id))
+    num_source_files = sum([ len(files) for path, files in tree ])
+    size_source_files = sum([ int(file.get('size') or 0) for path, files in tree for file in files ])
+    print('%d files found in %d directories (%s)' % (num_source_files, len(tree),
+        format_pretty_size(size_source_files)))
+    profile_mark('source files listed')
+    if num_source_files == 0:
+        sys.exit(0)
+
+    # Show confirmation
+    print('\n--The following operation will be executed--')
+    print('Copy up to %d files from your Google Drive path\n  >>>"%s"<<<' % (num_source_files, source_root))
+    print('to\n  >>>"%s"<<<.' % dest_root)
+    if options['checksum']:
+        print('Files with the same content (MD5) will be skipped, changed files replaced.')
+    else:
+        print('Files with the same size will be skipped, changed files replaced.')
+    print('Operation can be interrupted at any time by >>>Ctrl+C<<<.')
+    if not options['skip_confirmation'] and input('Are you sure [y/N]? ').upper() != 'Y':
+        print('Operation aborted!')
+        sys.exit(1)
+
+    hasher = None
+    if options['checksum']:
+        from hash_cache import FileHasher
+        hasher = FileHasher(HASH_CACHE_FILE)
+
+    # --- It's show time ---
+    profile_mark('ready to download')
+    print(datetime.now().strftime("%d/%m/%Y %H:%M:%S"))
+
+    global g_stop_loop
+    signal.signal(signal.SIGINT, signal_handler)
+
+    global g_progress_bar
+    g_progress_bar = ProgressBar(MAX_CONCURRENT_DOWNLOADS)
+    g_progress_bar.start()
+
+    shared_data = {
+        'lock': threading.Lock(),
+        'size_downloaded_files': 0,
+        'num_downloaded_files': 0,
+        'num_download_errors': 0,
+        'num_existing_files': 0,
+        'num_skipped_files': 0,
+        'num_processed_files': 0,
+        'error_streak': 0,
+    }
+    ERROR_STREAK_ABORT = 10 # quota errors are retried by the Drive's rate limiter, these are real
+
+    # Work queue
+    def download_task(data):
+        shared_data = data['shared_data']
+        file_data = data['file_data']
+        tid = Worker.current_thread_id()
+        my_drive = g_thread_data[tid]['drive']
+
+        g_progress_bar.clear()
+        print('[%d] downloading file "%s" (%s)' % (tid, file_data['short_file_name'],
+            format_pretty_size(file_data['file_size'])))
+        g_progress_bar.redraw()
+
+        partial_file_path = file_data['full_file_path'] + PARTIAL_FILE_SUFFIX
+        try:
+            callback = lambda progress, total, chunk_size=None: (g_progress_bar.update_part(tid, progress, total),
+                g_progress_bar.update_total(shared_data['num_processed_files'], num_source_files))
+            if file_data['segmented']:
+                my_drive.download_file_segmented(file_data['id'], partial_file_path,
+                    num_connections=options['connections'], progress_callback=callback)
+            else:
+                with open(partial_file_path, 'wb') as f:
+                    my_drive.download_file(file_data['id'], f, progress_callback=callback)
+            os.replace(partial_file_path, file_data['full_file_path'])
+
+            with shared_data['lock']:
+                shared_data['size_downloaded_files'] += file_data['file_size']
+                shared_data['num_downloaded_files'] += 1
+                shared_data['num_processed_files'] += 1
+                shared_data['error_streak'] = 0
+        except Exception as e:
+            print('**File download error: ' + str(e))
+            if not file_data['segmented']: # those continue on the next run
+                try:
+                    os.remove(partial_file_path)
+                except OSError:
+                    pass
+            with shared_data['lock']:
+                shared_data['num_download_errors'] += 1
+                shared_data['num_processed_files'] += 1
+                shared_data['error_streak'] += 1
+
+    # Prepare and start worker threads
+    for i in range(MAX_CONCURRENT_DOWNLOADS):
+        g_thread_data.append({ 'drive': drive.duplicate_service() })
+    queue_size = 2*MAX_CONCURRENT_DOWNLOADS if options['schedule'] == SCHEDULE_FIFO else SCHEDULE_LOOKAHEAD
+    queue = Dispatcher(MAX_CONCURRENT_DOWNLOADS, queue_size, download_task, policy=options['schedule'])
+    queue.start()
+
+    # Walk each directory of the source (including the root)
+    start_time = time.time()
+    for relative_path, files in tree:
+        local_dir = clean_path(os.path.join(dest_root, relative_path))
+        if not is_inside(local_dir, dest_root):
+            print('Folder "%s" not downloaded, it would be out of the destination' % relative_path)
+            with shared_data['lock']:
+                shared_data['num_skipped_files'] += len(files)
+                shared_data['num_processed_files'] += len(files)
+            continue
+        os.makedirs(local_dir, exist_ok=True)
+        existing_files = find_existing_files(local_dir, [ file for file in files
+            if 'md5Checksum' in file ], hasher)
+        names = set()
+
+        # Walk each file in this directory
+        for file in files:
+            file_name = local_file_name(file['name'])
+            short_file_name = relative_path + '/' + (file_name or file['name']) if relative_path \
+                else (file_name or file['name'])
+            if file_name is None:
+                print('File "%s" not downloaded, its name can\'t be a local one' % short_file_name)
+                with shared_data['lock']:
+                    shared_data['num_skipped_files'] += 1
+                    shared_data['num_processed_files'] += 1
+            elif 'md5Checksum' not in file:
+                print('File "%s" not downloaded, Google Docs files have no content to download'
+                    % short_file_name)
+                with shared_data['lock']:
+                    shared_data['num_skipped_files'] += 1
+                    shared_data['num_processed_files'] += 1
+            elif file_name in names:
+                print('File "%s" not downloaded, another file has the same name' % short_file_name)
+                with shared_data['lock']:
+                    shared_data['num_skipped_files'] += 1
+                    shared_data['num_processed_files'] += 1
+            elif file_name in existing_files:
+                with shared_data['lock']:
+                    shared_data['num_existing_files'] += 1
+                    shared_data['num_processed_files'] += 1
+            else:
+                file_size = int(file['size'])
+                data = {
+                    'shared_data': shared_data,
+                    'file_data': {
+                        'id': file['id'],
+                        'short_file_name': short_file_name,
+                        'full_file_path': os.path.join(local_dir, file_name),
+                        'file_size': file_size,
+                        'segmented': options['connections'] > 1 and file_size >= SEGMENTED_MIN_SIZE,
+                    },
+                }
+                queue.submit(data, file_size) # waits while the queue is full
+
+                # Error handling
+                if shared_data['error_streak'] >= ERROR_STREAK_ABORT:
+                    print('Too many sequential errors, aborting...')
+                    g_stop_loop = True
+            names.add(file_name)
+
+            if g_stop_loop:
+                queue.clear_data()
+                break # for file
+        if g_stop_loop:
+            queue.clear_data()
+            break # for path
+
+    # Wait for the queued downloads to finish
+    queue.join()
+    queue.stop()
+    if hasher:
+        hasher.close()
+
+    end_time = time.time()
+    elapsed_time = end_time - start_time
+
+    g_progress_bar.stop()
+    g_progress_bar.clear()
+
+    # Show final statistics
+    print('\n--Operation completed--')
+    print('Time taken: ' + format_pretty_time(elapsed_time))
+    print('Average download speed:  %s/s | %d file(s)/min' % (
+        format_pretty_size(shared_data['size_downloaded_files'] / elapsed_time),
+        round(shared_data['num_downloaded_files'] * 60 / elapsed_time)))
+    if shared_data['size_downloaded_files'] != 0:
+        print('Time to 1 GB: %s' % format_pretty_time(GIGA * elapsed_time / shared_data['size_downloaded_files']))
+    print('%d file(s) downloaded (%s)' % (
+        shared_data['num_downloaded_files'],
+        format_pretty_size(shared_data['size_downloaded_files'])))
+    print('%d file(s) failed to download' % shared_data['num_download_errors'])
+    if shared_data['num_skipped_files'] > 0:
+        print('%d file(s) skipped' % shared_data['num_skipped_files'])
+    print('%d file(s) already existed' % shared_data['num_existing_files'])
+    print('')
+
+USAGE = """
+python download.py [OPTIONS] [--source SOURCE_ROOT] [--dest DEST_ROOT]
+  Options:
+    --ask-source Ask for source (even if source is specified).
+    --ask-dest Ask for destination (even if dest is specified).
+    --schedule POLICY Order in which the queued files are downloaded: 'fifo' (as
+found, default), 'largest' first (shortens the tail of the run) or 'mixed'
+(largest and smallest alternated). Files waiting too long go next anyway.
+    --checksum Compare files by content (MD5) instead of by size: local files
+with the same content are skipped, changed files are replaced.
+    --connections N Connections per file for files from 256 MB on, which are
+downloaded in segments (default 4, 1 downloads them as the others).
+    --skip-confirmation Don't ask before starting.
+    --profile-startup Report how long each startup phase took, on exit.
+  --source SOURCE_ROOT Source path on the Drive from which all contents will be
+downloaded. The root directory itself will not be copied.
+  --dest DEST_ROOT Local directory inside of which SOURCE's content will be
+put. Created if it doesn't exist.
+"""
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage=USAGE)
+    parser.add_argument('--ask-source', action='store_true', default=False)
+    parser.add_argument('--ask-dest', action='store_true', default=False)
+    parser.add_argument('--source')
+    parser.add_argument('--dest')
+    parser.add_argument('--skip-confirmation', action='store_true', default=False)
+    parser.add_argument('--checksum', action='store_true', default=False)
+    parser.add_argument('--connections', type=int, default=SEGMENT_CONNECTIONS)
+    parser.add_argument('--schedule', choices=SCHEDULE_POLICIES, default=SCHEDULE_FIFO)
+    parser.add_argument('--profile-startup', action='store_true', default=False)
+    args = parser.parse_args()
+    if args.profile_startup:
+        profile_startup()
+        profile_mark('arguments parsed')
+
+    if args.ask_source or not args.source:
+        args.source = ask_for_source(args.source)
+
+    if not args.source:
+        print('No source specified')
+        sys.exit(1)
+
+    if args.ask_dest or not args.dest:
+        args.dest = ask_for_dest(args.dest)
+
+    if not args.dest:
+        print('No destination selected')
+        sys.exit(1)
+
+    main(args.source, args.dest, { 'skip_confirmation': args.skip_confirmation,
+        'checksum': args.checksum, 'schedule': args.schedule, 'connections': args.connections })
@@ -7,21 +7,55 @@ import sys
 import os.path
 import mimetypes
 import io
-from googleapiclient.discovery import build
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.discovery import build_from_document
 from googleapiclient.http import MediaFileUpload
-from googleapiclient.http import MediaIoBaseDownload
-from google_auth_oauthlib.flow import InstalledAppFlow
+from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.http import MediaUpload
+from googleapiclient.http import build_http
+from googleapiclient.errors import HttpError
+from google_auth_httplib2 import AuthorizedHttp
+try:
+    from googleapiclient.discovery_cache import get_static_doc
+except ImportError: # googleapiclient < 2.0, no bundled documents
+    get_static_doc = None
 from google.auth.transport.requests import Request
 from google.auth.exceptions import RefreshError
 from google.oauth2.credentials import Credentials
 
 from auxiliar import *
+from folder_index import FolderIndex
+from rate_limiter import RateLimiter, RateLimitedHttp, RATE_LIMIT_MAX_RETRIES, \
+    is_rate_limit_error, retry_delay
+from metadata_cache import LISTING_DIRS, LISTING_FILES, FOLDER_MIME_TYPE, parse_file_fields
 
 AUTH_SCOPES = [ 'https://www.googleapis.com/auth/drive' ]
 AUTH_SCOPES_READ_ONLY = [ 'https://www.googleapis.com/auth/drive.readonly' ]
 AUTH_SCOPE_ACTIVITY = 'https://www.googleapis.com/auth/drive.activity.readonly'
+CHANGE_FIELDS = 'fileId, removed, file(id, name, mimeType, parents, trashed, size, md5Checksum)'
 FOLDER_TYPE_FILTER = "mimeType='application/vnd.google-apps.folder'"
 NOT_FOLDER_TYPE_FILTER = "mimeType!='application/vnd.google-apps.folder'"
+BATCH_MAX_SIZE = 100 # Drive batch endpoint limit
+MAX_PAGE_SIZE = 1000 # Drive files.list limit
+MAX_QUERY_LENGTH = 4000 # keeps the request URL well under the size limits
+CHUNK_SIZE_UNIT = 256 * 1024 # resumable upload chunks must be multiples of it
+MIN_CHUNK_SIZE = CHUNK_SIZE_UNIT
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+INITIAL_CHUNK_SIZE = 1024 * 1024
+CHUNK_TARGET_TIME = 3 # seconds
+CHUNK_MAX_RETRIES = 3
+MULTIPART_MAX_SIZE = 5 * 1024 * 1024 # smaller files are sent in a single request
+SEGMENT_SIZE = 64 * 1024 * 1024 # segmented downloads: bytes per segment
+SEGMENT_CONNECTIONS = 4 # segments fetched at once
+SEGMENTS_STATE_SUFFIX = '.segments'
+STREAM_BUFFER_SIZE = 8 * 1024 * 1024 # streamed downloads: at most this in memory
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/%s/%s/rest'
+DISCOVERY_CACHE_DIR = 'cache/discovery'
+API_ROOT_URL_VARIABLE = 'PYDRIVE_API_ROOT_URL' # set to use a stand-in server (see fake_drive_server.py)
+LOCAL_TOKEN = 'local' # sent to stand-in servers, instead of logging in
 
 """
 Print error message as in print.
@@ -29,6 +63,326 @@ Print error message as in print.
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
+"""
+Result of a request queued in a DriveBatch. Filled in when the batch is sent.
+"""
+class BatchResult:
+    def __init__(self):
+        self.done = False
+        self.response = None
+        self.exception = None
+
+    """
+    Get the response, or raise the request's error if it failed.
+    """
+    def get(self):
+        if self.exception is not None:
+            raise self.exception
+        return self.response
+
+"""
+Queue of API requests sent together through the Drive batch endpoint, up to
+BATCH_MAX_SIZE per HTTP round trip. Works as a context manager: whatever is
+still pending is sent on exit. Callbacks receive the BatchResult and may queue
+more requests (e.g. next pages), which go in the following round trip.
+Each request counts against the rate limit, and the ones that hit a quota are
+sent again in a later round trip.
+"""
+class DriveBatch:
+    def __init__(self, drive, max_size=BATCH_MAX_SIZE):
+        self.drive = drive
+        self.max_size = max_size
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    """
+    Queue a request. Returns its BatchResult.
+    """
+    def add(self, request, callback=None):
+        result = BatchResult()
+        self.pending.append((request, result, callback, 0))
+        if len(self.pending) >= self.max_size:
+            self._send()
+        return result
+
+    """
+    Send everything pending, including requests queued by callbacks meanwhile.
+    """
+    def flush(self):
+        while len(self.pending) > 0:
+            self._send()
+
+    def _send(self):
+        pending = self.pending[:self.max_size]
+        self.pending = self.pending[self.max_size:]
+        throttled = []
+        def on_response(request_id, response, exception):
+            request, result, callback, retry = pending[int(request_id)]
+            if isinstance(exception, HttpError) and retry < RATE_LIMIT_MAX_RETRIES and \
+                    is_rate_limit_error(exception.resp.status, exception.content):
+                throttled.append((request, result, callback, retry + 1))
+                return
+            result.response = response
+            result.exception = exception
+            result.done = True
+        batch = self.drive.service.new_batch_http_request(callback=on_response)
+        for i in range(len(pending)):
+            batch.add(pending[i][0], request_id=str(i))
+        self.drive.rate_limiter.acquire(len(pending) - 1) # the batch request itself takes one more
+        batch.execute()
+        if len(throttled) > 0:
+            self.drive.rate_limiter.throttled(retry_delay(min(retry for *_, retry in throttled)))
+            self.pending = throttled + self.pending
+        for request, result, callback, retry in pending:
+            if callback and result.done:
+                callback(result)
+
+"""
+Chooses the chunk size of a transfer from the throughput measured on the
+previous chunks, aiming at chunks of CHUNK_TARGET_TIME seconds: big enough for
+the per-chunk round trip to be negligible on fast links, small enough for a
+failed chunk to be cheap to retry on slow ones.
+"""
+class ChunkSizeController:
+    def __init__(self, chunk_size=INITIAL_CHUNK_SIZE, min_size=MIN_CHUNK_SIZE,
+            max_size=MAX_CHUNK_SIZE, target_time=CHUNK_TARGET_TIME):
+        self.chunk_size = chunk_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_time = target_time
+        self.start_time = None
+
+    """
+    Mark the start of a chunk.
+    """
+    def start(self):
+        self.start_time = time.monotonic()
+
+    """
+    Account a finished chunk of the given size and adjust the chunk size (at
+    most 4x bigger or 2x smaller at a time).
+    Returns the new chunk size.
+    """
+    def update(self, num_bytes):
+        elapsed = time.monotonic() - self.start_time
+        if num_bytes > 0 and elapsed > 0:
+            ideal = num_bytes / elapsed * self.target_time
+            self._set(min(max(ideal, self.chunk_size / 2), self.chunk_size * 4))
+        return self.chunk_size
+
+    """
+    Account a failed chunk: the next ones are smaller.
+    Returns the new chunk size.
+    """
+    def failed(self):
+        self._set(self.chunk_size / 2)
+        return self.chunk_size
+
+    def _set(self, size):
+        size = int(size) // CHUNK_SIZE_UNIT * CHUNK_SIZE_UNIT
+        self.chunk_size = min(max(size, self.min_size), self.max_size)
+
+"""
+Read-only, seekable stream of the content of a Drive file (see
+Drive.open_download). It's fetched in ranged requests as it's read, holding a
+single chunk in memory: chunk sizes adapt to the throughput as in downloads,
+up to buffer_size. Not thread-safe, use with a Drive not used elsewhere at the
+same time (e.g. from duplicate_service()).
+"""
+class DownloadStream(io.RawIOBase):
+    def __init__(self, drive, file_id, size, buffer_size=STREAM_BUFFER_SIZE):
+        self.drive = drive
+        self.file_id = file_id
+        self.size = size
+        self.position = 0
+        self.buffer = b''
+        self.buffer_start = 0
+        self.chunks = ChunkSizeController(chunk_size=min(INITIAL_CHUNK_SIZE, buffer_size),
+            max_size=buffer_size)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        offset = self.position - self.buffer_start
+        if offset < 0 or offset >= len(self.buffer):
+            self.buffer = b'' # release it before fetching the next
+            self.buffer = self.drive.download_range(self.file_id, self.position,
+                min(self.position + self.chunks.chunk_size, self.size), self.chunks)
+            self.buffer_start = self.position
+            offset = 0
+        num_bytes = min(len(buffer), len(self.buffer) - offset)
+        buffer[:num_bytes] = self.buffer[offset:offset + num_bytes]
+        self.position += num_bytes
+        return num_bytes
+
+    def close(self):
+        self.buffer = b''
+        super().close()
+
+"""
+Resumable upload media read from a non-seekable source: a readable object
+(file-like, e.g. sys.stdin.buffer or a pipe) or an iterable of bytes (e.g. a
+generator). Only the data the server didn't confirm yet is kept, about two
+chunks, so retries of a chunk don't need to read the source again. The size may
+be unknown: the source is read a chunk ahead, so the size is known by the time
+the last chunk is sent (as the protocol needs). A readable source ends when a
+read returns nothing, an iterable when it stops (empty items are skipped).
+Since the source can't be read again, an interrupted upload can't be resumed
+by another process: there's no journal entry for it.
+"""
+class StreamMediaUpload(MediaUpload):
+    def __init__(self, source, mimetype, chunksize=INITIAL_CHUNK_SIZE, size=None):
+        if hasattr(source, 'read'):
+            self._read = source.read
+            self._iterator = None
+        else:
+            self._read = None
+            self._iterator = iter(source)
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._size = size
+        self._buffer = bytearray()
+        self._buffer_start = 0 # offset of the buffer in the stream
+        self._last_length = 0 # of the last chunk taken
+        self._eof = False
+
+    def chunksize(self):
+        return self._chunksize
+
+    """
+    Change the size of the next chunks.
+    """
+    def set_chunksize(self, chunksize):
+        self._chunksize = chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        if self._size is None:
+            # the next chunk starts at most after the last one
+            self._fill(self._last_length + self._chunksize + 1)
+            if self._eof:
+                self._size = self._buffer_start + len(self._buffer)
+        return self._size
+
+    def resumable(self):
+        return True
+
+    def getbytes(self, begin, length):
+        if begin < self._buffer_start:
+            raise IOError('Stream already consumed at offset %d' % begin)
+        del self._buffer[:begin - self._buffer_start] # confirmed by the server
+        self._buffer_start = begin
+        self._last_length = length
+        self._fill(length)
+        return bytes(self._buffer[:length])
+
+    """
+    Serialization is what resuming in another process would need, which a
+    stream doesn't support (see above).
+    """
+    def to_json(self):
+        raise TypeError('Stream uploads can\'t be serialized, nor resumed later')
+
+    def _fill(self, length):
+        while len(self._buffer) < length and not self._eof:
+            if self._iterator is None:
+                data = self._read(length - len(self._buffer))
+                if not data:
+                    self._eof = True
+                    return
+            else:
+                data = next(self._iterator, None)
+                if data is None:
+                    self._eof = True
+                    return
+            self._buffer.extend(data)
+
+"""
+Check if an error is worth retrying the same chunk for (server or connection
+errors).
+"""
+def is_transient_error(error):
+    if isinstance(error, HttpError):
+        return error.resp.status >= 500
+    return isinstance(error, OSError)
+
+"""
+A ranged download answered with something else than the range (e.g. the whole
+content). Not transient: the server would answer the same again.
+"""
+class RangeNotSupportedError(Exception):
+    pass
+
+# Parsed discovery documents, shared by all service objects
+_discovery_documents = {}
+_discovery_lock = threading.Lock()
+
+"""
+Get the parsed discovery document of an API, which service objects are built
+from: the one bundled with googleapiclient or, if there's none, a copy fetched
+once and kept in DISCOVERY_CACHE_DIR. It's parsed once per process.
+If root_url is given, the API is served there instead of by Google.
+"""
+def get_discovery_document(name, version, root_url=None):
+    with _discovery_lock:
+        document = _discovery_documents.get((name, version, root_url))
+        if document is None:
+            document = json.loads(_load_discovery_document(name, version))
+            if root_url:
+                document['rootUrl'] = document['mtlsRootUrl'] = root_url
+                document['baseUrl'] = root_url + document['servicePath']
+            # googleapiclient fixes up the methods of the document in place as
+            # they are first built, so get all that done before sharing it
+            _build_all_resources(build_from_document(document, http=build_http()), document)
+            _discovery_documents[(name, version, root_url)] = document
+        return document
+
+def _load_discovery_document(name, version):
+    content = get_static_doc(name, version) if get_static_doc else None
+    if content is not None:
+        return content
+    cache_file = os.path.join(DISCOVERY_CACHE_DIR, '%s.%s.json' % (name, version))
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rt') as f:
+            return f.read()
+    uri = DISCOVERY_URL % (name, version)
+    resp, content = build_http().request(uri)
+    if resp.status >= 400:
+        raise HttpError(resp, content, uri=uri)
+    os.makedirs(DISCOVERY_CACHE_DIR, exist_ok=True)
+    with open(cache_file, 'wb') as f:
+        f.write(content)
+    return content
+
+def _build_all_resources(resource, description):
+    for name, child in description.get('resources', {}).items():
+        _build_all_resources(getattr(resource, name)(), child)
+
 """
 Class for accessing Google Drive files.
 """
@@ -36,13 +390,21 @@ class Drive:
     """
     Constructor.
     """
-    def __init__(self, read_only=False, token_file=None, include_activity=False):
+    def __init__(self, read_only=False, token_file=None, include_activity=False, cache=None,
+            upload_journal=None, rate_limiter=None):
         self.service = None
         self.credentials = None
         self.read_only = read_only
         self.token_file = token_file or 'token.json'
         self.include_activity_api = include_activity
         self.activity_service = None
+        self.cache = cache
+        self.root_id = None
+        self.folder_index = None
+        self.upload_journal = upload_journal
+        self.path_lock = threading.Lock() # serializes the creation of paths
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.root_url = os.environ.get(API_ROOT_URL_VARIABLE) # None for Google's
     
     """
     Authenticate me via OAuth.
@@ -66,6 +428,7 @@ class Drive:
                 except RefreshError:
                     os.remove(self.token_file)
             if not refreshed:
+                from google_auth_oauthlib.flow import InstalledAppFlow # only for new logins
                 flow = InstalledAppFlow.from_client_secrets_file(
                     secret_file, requested_auth_scopes)
                 creds = flow.run_local_server(port=0)
@@ -99,24 +462,90 @@ class Drive:
     Execute a file list request and get all pages of it.
     """
     def _files_list_all_pages(self, **kwargs):
+        all_files = []
+        for files in self._files_list_pages(**kwargs):
+            all_files.extend(files)
+        return all_files
+
+    """
+    Execute a file list request and yield the files of each page as it comes.
+    """
+    def _files_list_pages(self, **kwargs):
         fields = kwargs['fields']
         if fields.find('nextPageToken') == -1 and fields != '*':
             kwargs['fields'] = 'nextPageToken, ' + fields
-        all_files = []
         pageToken = None
         while True:
             results = self.service.files().list(**kwargs, pageToken=pageToken).execute()
-            all_files.extend(safe_get_field(results, 'files'))
+            yield safe_get_field(results, 'files') or []
             pageToken = safe_get_field(results, 'nextPageToken')
             if not pageToken:
-                return all_files
+                return
+
+    """
+    Same as _files_list_all_pages, but queued in a batch. Following pages are
+    requested on the batch's next round trips.
+    Returns a BatchResult with the list of all files as response.
+    """
+    def _files_list_all_pages_batched(self, batch, **kwargs):
+        fields = kwargs['fields']
+        if fields.find('nextPageToken') == -1 and fields != '*':
+            kwargs['fields'] = 'nextPageToken, ' + fields
+        all_files = BatchResult()
+        all_files.response = []
+        def on_page(page):
+            if page.exception is not None:
+                all_files.exception = page.exception
+                all_files.done = True
+                return
+            all_files.response.extend(safe_get_field(page.response, 'files') or [])
+            pageToken = safe_get_field(page.response, 'nextPageToken')
+            if pageToken:
+                batch.add(self.service.files().list(**kwargs, pageToken=pageToken),
+                    callback=on_page)
+            else:
+                all_files.done = True
+        batch.add(self.service.files().list(**kwargs), callback=on_page)
+        return all_files
+
+    """
+    Get the actual id of the Drive root (the 'root' alias), if already known.
+    """
+    def _known_root_id(self):
+        if not self.root_id and self.cache:
+            self.root_id = self.cache.get_state('root_id')
+        return self.root_id
+
+    def _set_root_id(self, root_id):
+        self.root_id = root_id
+        if self.cache:
+            self.cache.set_state('root_id', root_id)
+        return root_id
+
+    """
+    Start a batch of requests (see DriveBatch).
+    """
+    def batch(self):
+        return DriveBatch(self)
                 
     """
-    Connect to the service.
+    Build a service object whose requests go through the rate limiter. It's
+    made from the shared discovery document, so no network round trip.
+    """
+    def _build_service(self, name, version):
+        http = AuthorizedHttp(self.credentials, http=build_http())
+        return build_from_document(get_discovery_document(name, version, self.root_url),
+            http=RateLimitedHttp(http, self.rate_limiter))
+
+    """
+    Connect to the service. A stand-in server (root_url) needs no login.
     """
     def connect(self, secret_file):
-        self.credentials = self._oauth_me(secret_file)
-        self.service = build('drive', 'v3', credentials=self.credentials)
+        if self.root_url:
+            self.credentials = Credentials(LOCAL_TOKEN)
+        else:
+            self.credentials = self._oauth_me(secret_file)
+        self.service = self._build_service('drive', 'v3')
         return self.service is not None
     
     """
@@ -124,16 +553,23 @@ class Drive:
     """
     def connect_activity(self):
         if self.activity_service is None and self.include_activity_api:
-            self.activity_service = build('driveactivity', 'v2', credentials=self.credentials)
+            self.activity_service = self._build_service('driveactivity', 'v2')
         return self.activity_service is not None
     
     """
     Duplicate this service instance with a new http backend (make thread-safe).
+    All duplicates share the rate limiter.
     """
     def duplicate_service(self):
-        new_service = Drive()
+        new_service = Drive(rate_limiter=self.rate_limiter)
         new_service.credentials = self.credentials
-        new_service.service = build('drive', 'v3', credentials=new_service.credentials)
+        new_service.cache = self.cache
+        new_service.root_id = self.root_id
+        new_service.folder_index = self.folder_index
+        new_service.upload_journal = self.upload_journal
+        new_service.path_lock = self.path_lock
+        new_service.root_url = self.root_url
+        new_service.service = new_service._build_service('drive', 'v3')
         return new_service
 
     """
@@ -142,12 +578,84 @@ class Drive:
     """
     def list_files(self, root_id, query=None, fields='id, name', order='name'):
         debug_trace(root_id)
+        cache_fields = parse_file_fields(fields) if self.cache and not query and order == 'name' else None
+        if cache_fields:
+            results = self.cache.get_listing(root_id, LISTING_FILES, cache_fields)
+            if results is not None:
+                return results
         results = self._files_list_all_pages(
             q=self._build_query(NOT_FOLDER_TYPE_FILTER, self._parent_filter(root_id), query),
             fields='files('+fields+')',
-            pageSize=100, orderBy=order)
+            pageSize=MAX_PAGE_SIZE, orderBy=order)
+        if cache_fields:
+            self.cache.set_listing(root_id, LISTING_FILES, results, cache_fields)
         return results
     
+    """
+    List all files of many directories at once. Their parent filters are OR'ed
+    in as few queries as the query length allows, all sent in a single batch,
+    and the results are split back per directory.
+    Returns dict of directory id -> list of dicts with the requested fields,
+    sorted by name.
+    """
+    def list_files_multi(self, root_ids, fields='id, name'):
+        debug_trace(root_ids)
+        results = { id: None for id in root_ids }
+        cache_fields = parse_file_fields(fields) if self.cache else None
+        if cache_fields:
+            for id in results:
+                results[id] = self.cache.get_listing(id, LISTING_FILES, cache_fields)
+        missing = [ id for id in results if results[id] is None ]
+        groups = []
+        query_length = MAX_QUERY_LENGTH
+        for id in missing:
+            parent_filter = self._parent_filter(id)
+            if query_length + len(parent_filter) + 4 > MAX_QUERY_LENGTH:
+                groups.append([])
+                query_length = len(self._build_query(NOT_FOLDER_TYPE_FILTER, '()'))
+            groups[-1].append(id)
+            query_length += len(parent_filter) + 4 # ' or '
+        has_parents = 'parents' in [ f.strip() for f in fields.split(',') ]
+        query_fields = fields if has_parents else fields + ', parents'
+        with self.batch() as batch:
+            group_files = [ self._files_list_all_pages_batched(batch,
+                q=self._build_query(NOT_FOLDER_TYPE_FILTER,
+                    '(' + ' or '.join([ self._parent_filter(id) for id in group ]) + ')'),
+                fields='files(' + query_fields + ')',
+                pageSize=MAX_PAGE_SIZE, orderBy='name') for group in groups ]
+        for i in range(len(groups)):
+            group = set(groups[i])
+            for id in group:
+                results[id] = []
+            for file in group_files[i].get():
+                entry = file if has_parents else { k: v for k, v in file.items() if k != 'parents' }
+                for parent_id in file.get('parents') or []:
+                    if parent_id in group:
+                        results[parent_id].append(entry)
+            if cache_fields:
+                for id in groups[i]:
+                    self.cache.set_listing(id, LISTING_FILES, results[id], cache_fields)
+        return results
+
+    """
+    List ALL files (whole drive, folders excluded) in a single paged query.
+    Returns list of dicts with the requested fields.
+    """
+    def list_all_files(self, fields='id, name, size, md5Checksum, parents'):
+        debug_trace(fields)
+        return list(self.iter_all_files(fields))
+
+    """
+    Same as list_all_files, but yields the files page by page as they come.
+    """
+    def iter_all_files(self, fields='id, name, size, md5Checksum, parents'):
+        debug_trace(fields)
+        for files in self._files_list_pages(
+                q=self._build_query(NOT_FOLDER_TYPE_FILTER),
+                fields='files('+fields+')',
+                pageSize=MAX_PAGE_SIZE):
+            yield from files
+
     """
     Get the ids of the (possibly) multiple files with the given name (or None if
     it doesn't exist).
@@ -171,18 +679,62 @@ class Drive:
         res = safe_get_field(result, 'parents')
         return res if res != None else []
 
+    """
+    Get the size and MD5 of a file's content, as the Drive has it.
+    Returns (size, md5), None for what the file has none of (e.g. Google Docs).
+    """
+    def get_content_info(self, id):
+        debug_trace(id)
+        result = self.service.files().get(fileId=id, fields='size, md5Checksum').execute()
+        size = safe_get_field(result, 'size')
+        return (int(size) if size is not None else None), safe_get_field(result, 'md5Checksum')
+
+    """
+    Delete a file (by id), for good.
+    """
+    def delete_file(self, id):
+        debug_trace(id)
+        self.service.files().delete(fileId=id).execute()
+        if self.cache:
+            self.cache.remove(id)
+
     """
     List all subdirectories of a directory.
     Returns list of dicts with 'id' and 'name'.
     """
     def list_subdirs(self, root_id):
         debug_trace(root_id)
+        if self.folder_index and self.folder_index.contains(root_id):
+            return self.folder_index.list_subdirs(root_id)
+        if self.cache:
+            results = self.cache.get_listing(root_id, LISTING_DIRS)
+            if results is not None:
+                return results
         results = self._files_list_all_pages(
             q=self._build_query(FOLDER_TYPE_FILTER, self._parent_filter(root_id)),
             fields='files(id, name)',
-            pageSize=100, orderBy='name')
+            pageSize=MAX_PAGE_SIZE, orderBy='name')
+        if self.cache:
+            self.cache.set_listing(root_id, LISTING_DIRS, results)
         return results
 
+    """
+    List all subdirectories and all files of a directory in a single query.
+    Returns a tuple of lists of dicts with 'id' and 'name'.
+    """
+    def list_subdirs_and_files(self, root_id):
+        debug_trace(root_id)
+        results = self._files_list_all_pages(
+            q=self._build_query(self._parent_filter(root_id)),
+            fields='files(id, name, mimeType)',
+            pageSize=MAX_PAGE_SIZE, orderBy='name')
+        dirs = []
+        files = []
+        for result in results:
+            is_dir = result.pop('mimeType', None) == FOLDER_MIME_TYPE
+            (dirs if is_dir else files).append(result)
+        return dirs, files
+
     """
     List ALL directories (whole drive) based on a word in it's name.
     Returns list of dicts with 'id', 'name' and 'parents'.
@@ -192,9 +744,30 @@ class Drive:
         results = self._files_list_all_pages(
             q=self._build_query(FOLDER_TYPE_FILTER, self._name_filter(name, exact=False)),
             fields='files(id, name, parents)',
-            pageSize=100, orderBy='name')
+            pageSize=MAX_PAGE_SIZE, orderBy='name')
         return results
 
+    """
+    Index all the folders under a root folder in memory, from a single paged
+    query for every folder of the Drive. Afterwards, path lookups, ensure_path
+    and list_subdirs inside it are dictionary walks: only the creation of
+    missing folders needs round trips. The folders also go to the cache, if any.
+    Returns the index (see FolderIndex).
+    """
+    def build_folder_index(self, root_id):
+        debug_trace(root_id)
+        if root_id == 'root':
+            root_id = self._known_root_id() or self._set_root_id(
+                self.service.files().get(fileId='root', fields='id').execute()['id'])
+        folders = self._files_list_all_pages(
+            q=self._build_query(FOLDER_TYPE_FILTER),
+            fields='files(id, name, parents)',
+            pageSize=MAX_PAGE_SIZE)
+        self.folder_index = FolderIndex(root_id, folders)
+        if self.cache:
+            self.cache.add_folders(self.folder_index.get_all())
+        return self.folder_index
+
     """
     Get the id of an immediate subdirectory (or None if it doesn't exist).
     """
@@ -216,25 +789,57 @@ class Drive:
         if check_exists:
             existing_id = self.get_subdir(root_id, name)
             if existing_id:
+                if self.cache:
+                    self.cache.add_folder(existing_id, root_id, name)
                 return existing_id
         result = self.service.files().create(fields='id', body={
             'name': name, 'parents': [ root_id ],
             'mimeType': 'application/vnd.google-apps.folder'}).execute()
+        if self.cache:
+            self.cache.add_folder(result['id'], root_id, name)
+        if self.folder_index:
+            self.folder_index.add(result['id'], root_id, name)
         return result['id']
 
     """
     Get the id of a nested subdirectory (or None if it doesn't exist).
+    With a folder index or a cache, the indexed or cached part of the path is
+    resolved without any round trip. The rest is looked up a directory at a
+    time, each inside its parent, and created if missing (with create).
     """
     def get_subpath(self, root_id, path, create=False):
         debug_trace(root_id, path, create)
-        current_root = root_id
-        for dir in filter(None, path.split('/')):
+        dirs = list(filter(None, path.split('/')))
+        current_root = (self._known_root_id() or root_id) if root_id == 'root' else root_id
+        index = self.folder_index
+        while len(dirs) > 0:
+            if index and index.contains(current_root):
+                with index.lock:
+                    sub = index.get_subdir(current_root, dirs[0])
+                    if not sub:
+                        if not create:
+                            return None
+                        sub = self.mkdir(current_root, dirs[0], check_exists=False)
+            elif self.cache:
+                sub = self.cache.get_subdir(current_root, dirs[0])
+                if not sub:
+                    break
+            else:
+                break
+            current_root = sub
+            dirs.pop(0)
+        if len(dirs) > 0 and current_root == 'root' and self.cache: # cached by the actual id
+            current_root = self._set_root_id(
+                self.service.files().get(fileId='root', fields='id').execute()['id'])
+        for dir in dirs:
             sub = self.get_subdir(current_root, dir)
+            if sub and self.cache:
+                self.cache.add_folder(sub, current_root, dir)
             if not sub:
                 if not create:
                     return None
-                else:
-                    sub = self.mkdir(current_root, dir, check_exists=False)
+                with self.path_lock: # another thread may have just created it
+                    sub = self.mkdir(current_root, dir)
             current_root = sub
         return current_root
 
@@ -253,29 +858,250 @@ class Drive:
     def ensure_path(self, path):
         debug_trace(path)
         return self.get_path(path, create=True)
+
+    """
+    Run an action (e.g. an upload) on the id of a path's directory, as found
+    earlier. A directory known from the cache may have been deleted meanwhile:
+    when the Drive answers it doesn't exist, the path's cached directories are
+    dropped and the action is retried once, on the path looked up (or made)
+    again.
+    Returns a tuple with the action's result and the directory id used.
+    """
+    def run_in_folder(self, path, id, action):
+        debug_trace(path, id)
+        try:
+            return action(id), id
+        except HttpError as e:
+            if not self.cache or e.resp.status != 404:
+                raise
+        eprint('INFO: cached folder not found, looking up again, ' + str(id) + ' ' + path)
+        current_root = self._known_root_id() or 'root'
+        for dir in filter(None, path.split('/')):
+            sub = self.cache.get_subdir(current_root, dir)
+            if not sub:
+                break
+            self.cache.remove(sub)
+            current_root = sub
+        id = self.ensure_path(path)
+        return action(id), id
     
     """
-    Download a file (by id).
+    Download a file (by id). The chunk size adapts to the measured throughput
+    (see ChunkSizeController) and is passed to the progress callback as third
+    argument. Without an output file, it's all kept in memory (see
+    open_download for big files).
     Returns the file id.
     """
     def download_file(self, file_id, output_file=None, progress_callback=None):
         debug_trace(file_id)
         request = self.service.files().get_media(fileId=file_id)
         file = io.BytesIO() if output_file == None else output_file
-        media = MediaIoBaseDownload(file, request, chunksize=1024*1024)
+        chunks = ChunkSizeController()
         if progress_callback:
             progress_callback(0, 0) # shows empty at first
-        done = False
-        while done is False:
-            status, done = media.next_chunk()
-            if status and progress_callback:
-                progress_callback(status.resumable_progress, status.total_size)
+        progress = 0
+        total_size = None
+        retries = 0
+        while total_size is None or progress < total_size:
+            chunks.start()
+            try:
+                content, total_size = self._download_chunk(request, progress, chunks.chunk_size)
+            except Exception as e:
+                if retries >= CHUNK_MAX_RETRIES or not is_transient_error(e):
+                    raise
+                retries += 1
+                chunks.failed()
+                continue
+            retries = 0
+            file.write(content)
+            progress += len(content)
+            chunks.update(len(content))
+            if progress_callback:
+                progress_callback(progress, total_size, chunks.chunk_size)
         file.seek(0)
         return file
+
+    """
+    Get a chunk of a media request's content, from start. Unless partial_only,
+    the whole content is taken too when the range is ignored from the start.
+    Returns a tuple with the chunk and the content's total size.
+    """
+    def _download_chunk(self, request, start, length, partial_only=False):
+        headers = dict(request.headers)
+        headers['range'] = 'bytes=%d-%d' % (start, start + length - 1)
+        resp, content = request.http.request(request.uri, 'GET', headers=headers)
+        if resp.status == 416 and start == 0: # empty content
+            return b'', 0
+        if resp.status >= 400:
+            raise HttpError(resp, content, uri=request.uri)
+        if resp.status == 206 and 'content-range' in resp:
+            return content, int(resp['content-range'].rsplit('/', 1)[1])
+        if resp.status == 200 and start == 0 and not partial_only: # the whole content
+            return content, len(content)
+        raise RangeNotSupportedError('Unexpected response (%d) for range %s' % (resp.status,
+            headers['range']))
+
+    """
+    Get a byte range (end exclusive) of a file's content in a ranged request,
+    retrying transient errors. The chunks controller, if any, is updated with
+    the measured throughput. Raises RangeNotSupportedError if the server
+    doesn't answer with the range (partial content).
+    Returns the bytes.
+    """
+    def download_range(self, file_id, start, end, chunks=None):
+        chunks = chunks or ChunkSizeController()
+        request = self.service.files().get_media(fileId=file_id)
+        retries = 0
+        while True:
+            chunks.start()
+            try:
+                content, total_size = self._download_chunk(request, start, end - start, partial_only=True)
+                if not content:
+                    raise IOError('Empty response for range %d-%d' % (start, end - 1))
+            except Exception as e:
+                if retries >= CHUNK_MAX_RETRIES or not is_transient_error(e):
+                    raise
+                retries += 1
+                chunks.failed()
+                continue
+            chunks.update(len(content))
+            return content
+
+    """
+    Open the content of a file (by id) for reading as a stream, without
+    holding more than buffer_size bytes of it in memory at once. It's seekable
+    and can be wrapped in io.BufferedReader, io.TextIOWrapper, zipfile, etc.
+    Returns a DownloadStream.
+    """
+    def open_download(self, file_id, buffer_size=STREAM_BUFFER_SIZE):
+        debug_trace(file_id)
+        file = self._get_downloadable(file_id, 'size')
+        return DownloadStream(self, file_id, file['size'], buffer_size)
+
+    """
+    Get the metadata of a file to download (the given fields, with 'size' and
+    'mimeType'), with 'size' as an int. Files with no content of their own, as
+    Google Docs, raise an IOError: exporting them isn't supported.
+    """
+    def _get_downloadable(self, file_id, fields):
+        file = self.service.files().get(fileId=file_id, fields=fields + ', size, mimeType').execute()
+        size = safe_get_field(file, 'size')
+        if size is None:
+            raise IOError('File %s (%s) has no content to download, exporting Google Docs isn\'t '
+                'supported' % (file_id, safe_get_field(file, 'mimeType')))
+        file['size'] = int(size)
+        return file
+
+    """
+    Download the content of a file (by id) as a generator of chunks, without
+    holding more than buffer_size bytes of it in memory at once.
+    """
+    def iter_download(self, file_id, buffer_size=STREAM_BUFFER_SIZE):
+        with self.open_download(file_id, buffer_size) as stream:
+            while True:
+                chunk = stream.read(buffer_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    """
+    Download a file (by id) into a local file over several connections at once.
+    The file is preallocated and split in segments of segment_size bytes, which
+    are fetched concurrently in ranged requests (with adaptive chunk sizes and
+    retries, as in download_file) and written at their offsets. The progress of
+    each segment is kept in a state file beside the output, so an interrupted
+    download continues where it stopped, as long as the Drive file is the same.
+    If the server doesn't serve ranges, it's downloaded in a single stream. The
+    result is checked against the Drive file's MD5 (if any), and removed if it
+    differs.
+    Returns the size of the file.
+    """
+    def download_file_segmented(self, file_id, full_file_path, num_connections=SEGMENT_CONNECTIONS,
+            segment_size=SEGMENT_SIZE, progress_callback=None):
+        debug_trace(file_id, full_file_path)
+        file = self._get_downloadable(file_id, 'md5Checksum')
+        size = file['size']
+        state_file = full_file_path + SEGMENTS_STATE_SUFFIX
+        state = None
+        if os.path.exists(full_file_path):
+            try:
+                with open(state_file, 'rt') as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                pass
+        if not state or [ state['id'], state['size'], state['md5'] ] != [ file_id, size,
+                file.get('md5Checksum') ]:
+            state = { 'id': file_id, 'size': size, 'md5': file.get('md5Checksum'),
+                'segment_size': segment_size,
+                'segments': { str(start): start for start in range(0, size, segment_size) } }
+            with open(full_file_path, 'wb') as f:
+                f.truncate(size)
+        segment_size = state['segment_size']
+        progress = [ size - sum([ min(int(start) + segment_size, size) - offset
+            for start, offset in state['segments'].items() ]) ]
+        lock = threading.Lock()
+        thread_data = threading.local()
+
+        def save_state():
+            temp_file = state_file + '.tmp'
+            with open(temp_file, 'wt') as f:
+                json.dump(state, f)
+            os.replace(temp_file, state_file)
+
+        def fetch_segment(start):
+            if not hasattr(thread_data, 'drive'):
+                thread_data.drive = self.duplicate_service() # one connection per thread
+            end = min(start + segment_size, size)
+            offset = state['segments'][str(start)]
+            chunks = ChunkSizeController()
+            with open(full_file_path, 'r+b') as f:
+                while offset < end:
+                    content = thread_data.drive.download_range(file_id, offset,
+                        min(offset + chunks.chunk_size, end), chunks)
+                    f.seek(offset)
+                    f.write(content)
+                    f.flush() # before the state says it's there
+                    offset += len(content)
+                    with lock:
+                        state['segments'][str(start)] = offset
+                        progress[0] += len(content)
+                        save_state()
+                        if progress_callback:
+                            progress_callback(progress[0], size, chunks.chunk_size)
+
+        if progress_callback:
+            progress_callback(progress[0], size)
+        pending = [ int(start) for start, offset in state['segments'].items()
+            if offset < min(int(start) + segment_size, size) ]
+        pool = ThreadPoolExecutor(num_connections)
+        ranges_supported = True
+        try:
+            for future in [ pool.submit(fetch_segment, start) for start in pending ]:
+                future.result()
+        except RangeNotSupportedError as e:
+            eprint('INFO: downloading in a single stream instead, ' + str(e))
+            ranges_supported = False
+        finally:
+            pool.shutdown(cancel_futures=True)
+        if not ranges_supported:
+            with open(full_file_path, 'wb') as f:
+                self.download_file(file_id, f, progress_callback)
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        from hash_cache import md5_file
+        if file.get('md5Checksum') and md5_file(full_file_path) != file['md5Checksum']:
+            os.remove(full_file_path)
+            raise IOError('The downloaded content differs from the Drive file (MD5), ' + full_file_path)
+        return size
         
     """
     Upload a file to a given directory (by id). Flag check_exists prevents file
-    duplication (yes, it duplicates), but also adds overhead.
+    duplication (yes, it duplicates), but also adds overhead. With an upload
+    journal, an upload interrupted before (even by another process) continues
+    from the last byte the server confirmed. The chunk size adapts to the
+    measured throughput (see ChunkSizeController) and is passed to the progress
+    callback as third argument. Files up to MULTIPART_MAX_SIZE skip all of that
+    and go in a single multipart request.
     Returns the file id.
     """
     def upload_file(self, root_id, full_file_path, progress_callback=None, check_exists=True, replace=False):
@@ -289,27 +1115,225 @@ class Drive:
                 if not replace:
                     return safe_get_field(existing_files, 0, 'id')
                 else:
-                    for file in existing_files:
-                        eprint('INFO: deleting a file, ' + str(file['id']) + ' ' + file_name)
-                        self.service.files().delete(fileId=file['id']).execute()
+                    self._delete_files(existing_files, file_name)
         
-        media = MediaFileUpload(full_file_path,
-            mimetype=mimetype,
-            chunksize=1024*1024,
-            resumable=True)
-        request = self.service.files().create(fields='id', body={
-            'name': file_name, 'parents': [ root_id ],
-            'mimeType': mimetype},
+        body = { 'name': file_name, 'parents': [ root_id ], 'mimeType': mimetype }
+        if os.path.getsize(full_file_path) <= MULTIPART_MAX_SIZE:
+            media = MediaFileUpload(full_file_path, mimetype=mimetype, resumable=False)
+            response = self._upload_multipart(body, media, progress_callback)
+        else:
+            make_media = lambda chunk_size: MediaFileUpload(full_file_path, mimetype=mimetype,
+                chunksize=chunk_size, resumable=True)
+            journal_key = self.upload_journal.make_key(full_file_path, root_id) \
+                if self.upload_journal else None
+            response = self._upload_resumable(body, make_media, progress_callback, journal_key)
+        if self.cache:
+            self.cache.add_file(response['id'], root_id, file_name,
+                size=response.get('size'), md5=response.get('md5Checksum'))
+        return response['id']
+
+    """
+    Delete files (dicts with 'id') of a given name, which are being replaced.
+    """
+    def _delete_files(self, files, file_name):
+        with self.batch() as batch:
+            deletions = []
+            for file in files:
+                eprint('INFO: deleting a file, ' + str(file['id']) + ' ' + file_name)
+                deletions.append(batch.add(self.service.files().delete(fileId=file['id'])))
+        for deletion in deletions:
+            deletion.get()
+        if self.cache:
+            for file in files:
+                self.cache.remove(file['id'])
+
+    """
+    Upload a file (media) in a single multipart (metadata + content) request.
+    Returns the response, with 'id', 'size' and 'md5Checksum'.
+    """
+    def _upload_multipart(self, body, media, progress_callback):
+        request = self.service.files().create(fields='id, size, md5Checksum', body=body,
             media_body=media)
+        if progress_callback:
+            progress_callback(0, 0) # shows empty at first
+        retries = 0
+        while True:
+            try:
+                response = request.execute()
+                break
+            except Exception as e:
+                if retries >= CHUNK_MAX_RETRIES or not is_transient_error(e):
+                    raise
+                retries += 1
+        if progress_callback:
+            progress_callback(media.size(), media.size(), media.size())
+        return response
+
+    """
+    Upload a file through a resumable session, in chunks (see upload_file). The
+    media is made by make_media for a given chunk size, again whenever the
+    chunk size changes. With a journal key, the session is recorded in the
+    upload journal and resumed from there.
+    Returns the response, with 'id', 'size' and 'md5Checksum'.
+    """
+    def _upload_resumable(self, body, make_media, progress_callback, journal_key=None):
+        file_name = body['name']
+        chunks = ChunkSizeController()
+        media = make_media(chunks.chunk_size)
+        make_request = lambda: self.service.files().create(fields='id, size, md5Checksum',
+            body=body, media_body=media)
+        request = make_request()
+        resuming = False
         response = None
+        session = self.upload_journal.get(journal_key) if journal_key else None
+        if session:
+            request.resumable_uri = session['uri']
+            try:
+                request.resumable_progress, response = self._get_upload_status(request, media)
+                eprint('INFO: resuming an upload at %d bytes, %s' % (request.resumable_progress, file_name))
+                resuming = True
+            except HttpError as e:
+                if e.resp.status not in [ 404, 410 ]:
+                    raise
+                eprint('INFO: upload session expired, restarting, ' + file_name)
+                self.upload_journal.remove(journal_key)
+                request = make_request()
         if progress_callback:
             progress_callback(0, 0) # shows empty at first
+        retries = 0
         while response is None:
-            status, response = request.next_chunk()
+            if media.chunksize() != chunks.chunk_size: # the rest goes in chunks of the new size
+                media = make_media(chunks.chunk_size)
+                request.resumable = media
+            progress = request.resumable_progress
+            chunks.start()
+            try:
+                status, response = request.next_chunk()
+            except Exception as e:
+                if resuming and isinstance(e, HttpError) and e.resp.status in [ 404, 410 ]:
+                    eprint('INFO: upload session expired, restarting, ' + file_name)
+                    self.upload_journal.remove(journal_key)
+                    request = make_request()
+                    resuming = False
+                    continue
+                if retries >= CHUNK_MAX_RETRIES or not is_transient_error(e):
+                    raise
+                retries += 1
+                # The chunk is sent again from the last confirmed byte (after
+                # an HTTP error, next_chunk asks the server for it first)
+                chunks.failed()
+                continue
+            retries = 0
+            chunks.update(request.resumable_progress - progress)
+            resuming = False
             if status and progress_callback:
-                progress_callback(status.resumable_progress, status.total_size)
+                progress_callback(status.resumable_progress, status.total_size or 0, chunks.chunk_size)
+            if journal_key and response is None:
+                self.upload_journal.set(journal_key, request.resumable_uri, request.resumable_progress)
+        if journal_key:
+            self.upload_journal.remove(journal_key)
+        return response
+
+    """
+    Ask the server how much it got of a resumable upload (the request's
+    resumable_uri), with an empty chunk as the protocol says.
+    Returns a tuple with the bytes received and the response if the upload is
+    complete (else None).
+    """
+    def _get_upload_status(self, request, media):
+        size = media.size()
+        resp, content = request.http.request(request.resumable_uri, 'PUT', headers={
+            'Content-Range': 'bytes */%s' % (size if size is not None else '*'), 'content-length': '0' })
+        if resp.status in [ 200, 201 ]:
+            return size, request.postproc(resp, content)
+        if resp.status != 308:
+            raise HttpError(resp, content, uri=request.resumable_uri)
+        received = resp.get('range') # as 'bytes=0-<last byte>', none if nothing
+        return (int(received.split('-')[1]) + 1 if received else 0), None
+
+    """
+    Upload the content of a stream (readable object or iterable of bytes, see
+    StreamMediaUpload) as a new file in a given directory (by id), with no temp
+    file: small contents go in a single multipart request, the others through
+    a resumable session, keeping about a chunk in memory. The size, if known,
+    is only informative (e.g. for the progress callback).
+    Returns the file id.
+    """
+    def upload_stream(self, root_id, name, source, size=None, progress_callback=None):
+        debug_trace(root_id, name, size)
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        body = { 'name': name, 'parents': [ root_id ], 'mimeType': mimetype }
+        media = StreamMediaUpload(source, mimetype, size=size)
+        head = media.getbytes(0, MULTIPART_MAX_SIZE + 1)
+        if len(head) <= MULTIPART_MAX_SIZE: # that's all of it
+            media = MediaIoBaseUpload(io.BytesIO(head), mimetype, resumable=False)
+            response = self._upload_multipart(body, media, progress_callback)
+        else:
+            def make_media(chunk_size): # the stream can't be read again, same media
+                media.set_chunksize(chunk_size)
+                return media
+            response = self._upload_resumable(body, make_media, progress_callback)
+        if self.cache:
+            self.cache.add_file(response['id'], root_id, name,
+                size=response.get('size'), md5=response.get('md5Checksum'))
         return response['id']
 
+    """
+    Copy a file (by id) into a given directory (by id), server-side: no content
+    is transferred. With replace, the files of that name already there are
+    deleted (once the copy is made).
+    Returns the new file id.
+    """
+    def copy_file(self, file_id, root_id, name, replace=False):
+        debug_trace(file_id, root_id, name, replace)
+        response = self.service.files().copy(fileId=file_id, fields='id, size, md5Checksum',
+            body={ 'name': name, 'parents': [ root_id ] }).execute()
+        if replace:
+            replaced = [ file for file in self.get_files(root_id, name) if file['id'] != response['id'] ]
+            if replaced:
+                self._delete_files(replaced, name)
+        if self.cache:
+            self.cache.add_file(response['id'], root_id, name,
+                size=response.get('size'), md5=response.get('md5Checksum'))
+        return response['id']
+
+    """
+    Bring the metadata cache up to date through the changes feed. The first
+    call only stores the feed's start token; the following ones fetch what
+    changed since the previous call and apply it, which keeps everything cached
+    in between valid without listing it again. If the feed has to be restarted,
+    the cache is emptied.
+    Returns the number of changes applied.
+    """
+    def refresh_cache(self):
+        debug_trace()
+        token = self.cache.get_state('changes_token')
+        since = float(self.cache.get_state('changes_token_time') or 0)
+        start_time = time.time()
+        num_changes = 0
+        try:
+            while token:
+                result = self.service.changes().list(pageToken=token, pageSize=MAX_PAGE_SIZE,
+                    includeRemoved=True, spaces='drive',
+                    fields='nextPageToken, newStartPageToken, changes(' + CHANGE_FIELDS + ')').execute()
+                changes = safe_get_field(result, 'changes') or []
+                self.cache.apply_changes(changes)
+                num_changes += len(changes)
+                token = safe_get_field(result, 'nextPageToken')
+                if not token:
+                    token = safe_get_field(result, 'newStartPageToken')
+                    self.cache.revalidate(since, start_time)
+                    break
+        except HttpError as e:
+            eprint('INFO: restarting the changes feed, ' + str(e))
+            token = None
+        if not token: # what's cached can't be brought up to date
+            self.cache.clear()
+            token = self.service.changes().getStartPageToken().execute()['startPageToken']
+        self.cache.set_state('changes_token', token)
+        self.cache.set_state('changes_token_time', str(start_time))
+        return num_changes
+
     """
     Get the last modified time for a file or directory. Based on the activity
     API, returns the correct time for folders which had modifications deep
@@ -0,0 +1,709 @@
+"""
+Local fake Google Drive (v3 API) server, for trying and benchmarking the
+programs without an account. Run with --help for more info.
+
+Raphael Pithan
+2021
+"""
+
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import threading
+import urllib.parse
+from datetime import datetime, timezone
+from email.parser import Parser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from metadata_cache import FOLDER_MIME_TYPE
+
+ROOT_ID = '0AFakeDriveRootFolder'
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+DEFAULT_FILE_FIELDS = 'kind, id, name, mimeType'
+BATCH_BOUNDARY = 'batch_fake_drive'
+API_PATH = '/drive/v3/'
+UPLOAD_PATH = '/upload/drive/v3/files'
+BATCH_PATH = '/batch/drive/v3'
+GOOGLE_APPS_MIME_PREFIX = 'application/vnd.google-apps.' # Docs, Sheets, etc. (and folders)
+
+"""
+Error answered by the fake Drive, in the same format as the real one.
+"""
+class FakeDriveError(Exception):
+    def __init__(self, status, reason, message):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+        self.message = message
+
+    def content(self):
+        return json.dumps({ 'error': { 'code': self.status, 'message': self.message,
+            'errors': [ { 'domain': 'global', 'reason': self.reason, 'message': self.message } ] } }).encode()
+
+def _now():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+"""
+Parse a 'fields' parameter (e.g. "nextPageToken, files(id, name)") into a dict
+of field -> sub-fields dict (or None for the whole value).
+"""
+def parse_fields(fields):
+    result = {}
+    stack = [ result ]
+    name = ''
+    for c in fields + ',':
+        if c in ',()':
+            name = name.strip()
+            if c == '(':
+                stack[-1][name] = {}
+                stack.append(stack[-1][name])
+            elif name:
+                stack[-1][name] = None
+            if c == ')':
+                stack.pop()
+            name = ''
+        else:
+            name += c
+    return result
+
+"""
+Keep only the selected fields (see parse_fields) of a resource.
+"""
+def select_fields(value, selection):
+    if selection is None or '*' in selection:
+        return value
+    if isinstance(value, list):
+        return [ select_fields(item, selection) for item in value ]
+    return { key: select_fields(value[key], sub) for key, sub in selection.items() if key in value }
+
+_QUERY_TOKEN = re.compile(r"\s*(?:'((?:\\.|[^'\\])*)'|(!=|<=|>=|[=<>()])|(\w+))")
+
+"""
+Parser of the Drive search query language ('q' parameter), for the subset the
+project uses (see Drive._build_query): comparisons of name, mimeType, trashed
+and the times, 'contains', "'id' in parents", and/or/not and parentheses.
+Besides the predicate, it finds which parents the query is limited to, so the
+files don't have to be scanned all.
+"""
+class _QueryParser:
+    def __init__(self, q, aliases):
+        self.aliases = aliases
+        self.tokens = []
+        position = 0
+        q = q.strip()
+        while position < len(q):
+            match = _QUERY_TOKEN.match(q, position)
+            if not match or match.end() == position:
+                raise FakeDriveError(400, 'invalid', 'Invalid Value')
+            string, op, word = match.groups()
+            if string is not None:
+                self.tokens.append(('string', re.sub(r'\\(.)', r'\1', string)))
+            elif op is not None:
+                self.tokens.append(('op', op))
+            else:
+                self.tokens.append(('word', word))
+            position = match.end()
+        self.position = 0
+
+    """
+    Returns (predicate on a file, set of parent ids or None for any).
+    """
+    def parse(self):
+        result = self._or()
+        if self.position != len(self.tokens):
+            raise FakeDriveError(400, 'invalid', 'Invalid Value')
+        return result
+
+    def _peek(self, kind=None, value=None):
+        if self.position >= len(self.tokens):
+            return None
+        token = self.tokens[self.position]
+        if (kind and token[0] != kind) or (value and token[1] != value):
+            return None
+        return token
+
+    def _next(self, kind=None, value=None):
+        token = self._peek(kind, value)
+        if token is None:
+            raise FakeDriveError(400, 'invalid', 'Invalid Value')
+        self.position += 1
+        return token[1]
+
+    def _or(self):
+        terms = [ self._and() ]
+        while self._peek('word', 'or'):
+            self._next()
+            terms.append(self._and())
+        if len(terms) == 1:
+            return terms[0]
+        parents = None
+        if all([ term[1] is not None for term in terms ]):
+            parents = set().union(*[ term[1] for term in terms ])
+        return (lambda file: any([ term[0](file) for term in terms ])), parents
+
+    def _and(self):
+        terms = [ self._atom() ]
+        while self._peek('word', 'and'):
+            self._next()
+            terms.append(self._atom())
+        if len(terms) == 1:
+            return terms[0]
+        limits = [ term[1] for term in terms if term[1] is not None ]
+        parents = min(limits, key=len) if limits else None
+        return (lambda file: all([ term[0](file) for term in terms ])), parents
+
+    def _atom(self):
+        if self._peek('op', '('):
+            self._next()
+            result = self._or()
+            self._next('op', ')')
+            return result
+        if self._peek('word', 'not'):
+            self._next()
+            predicate = self._atom()[0]
+            return (lambda file: not predicate(file)), None
+        if self._peek('string'):
+            value = self._next()
+            value = self.aliases.get(value, value)
+            self._next('word', 'in')
+            field = self._next('word')
+            return (lambda file: value in file.get(field, [])), ({ value } if field == 'parents' else None)
+        field = self._next('word')
+        if self._peek('word', 'contains'):
+            op = self._next()
+        else:
+            op = self._next('op')
+        if self._peek('string'):
+            value = self._next()
+        else:
+            value = { 'true': True, 'false': False }.get(self._next('word'))
+            if value is None:
+                raise FakeDriveError(400, 'invalid', 'Invalid Value')
+        compare = {
+            '=': lambda a, b: a == b,
+            '!=': lambda a, b: a != b,
+            '<': lambda a, b: a < b,
+            '<=': lambda a, b: a <= b,
+            '>': lambda a, b: a > b,
+            '>=': lambda a, b: a >= b,
+            'contains': lambda a, b: b in a,
+        }[op]
+        return (lambda file: field in file and compare(file[field], value)), None
+
+"""
+In-memory Drive: files with their metadata and content, and the change log.
+Thread-safe.
+"""
+class FakeDrive:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.contents = {}
+        self.children = { ROOT_ID: set() }
+        self.changes = []
+        self.uploads = {}
+        now = _now()
+        self.files[ROOT_ID] = { 'kind': 'drive#file', 'id': ROOT_ID, 'name': 'My Drive',
+            'mimeType': FOLDER_MIME_TYPE, 'parents': [], 'trashed': False,
+            'createdTime': now, 'modifiedTime': now }
+
+    def _resolve(self, file_id):
+        return ROOT_ID if file_id == 'root' else file_id
+
+    def _get(self, file_id):
+        file = self.files.get(self._resolve(file_id))
+        if file is None:
+            raise FakeDriveError(404, 'notFound', 'File not found: %s.' % file_id)
+        return file
+
+    def _add(self, metadata, content=None):
+        parents = [ self._resolve(id) for id in metadata.get('parents') or [ ROOT_ID ] ]
+        for parent_id in parents:
+            self._get(parent_id)
+        now = _now()
+        file = { 'kind': 'drive#file', 'id': uuid.uuid4().hex, 'name': metadata.get('name', 'Untitled'),
+            'mimeType': metadata.get('mimeType') or 'application/octet-stream', 'parents': parents,
+            'trashed': False, 'createdTime': now, 'modifiedTime': metadata.get('modifiedTime', now) }
+        if file['mimeType'].startswith(GOOGLE_APPS_MIME_PREFIX) and file['mimeType'] != FOLDER_MIME_TYPE:
+            pass # Google Docs etc. have no content of their own: no size, MD5 nor download
+        elif file['mimeType'] != FOLDER_MIME_TYPE:
+            content = bytes(content or b'')
+            file['size'] = str(len(content))
+            file['md5Checksum'] = hashlib.md5(content).hexdigest()
+            self.contents[file['id']] = content
+        else:
+            self.children[file['id']] = set()
+        self.files[file['id']] = file
+        for parent_id in parents:
+            self.children[parent_id].add(file['id'])
+        self.changes.append(file['id'])
+        return file
+
+    """
+    Create a file (or folder, by mimeType) from its metadata and content.
+    """
+    def create(self, metadata, content=None):
+        with self.lock:
+            return dict(self._add(metadata, content))
+
+    """
+    Create a folder by path from the root (and the missing ones on the way).
+    Returns its id.
+    """
+    def make_path(self, path):
+        with self.lock:
+            current = ROOT_ID
+            for name in filter(None, path.split('/')):
+                sub = [ id for id in self.children[current] if self.files[id]['name'] == name
+                    and self.files[id]['mimeType'] == FOLDER_MIME_TYPE ]
+                current = sub[0] if sub else self._add({ 'name': name, 'mimeType': FOLDER_MIME_TYPE,
+                    'parents': [ current ] })['id']
+            return current
+
+    def get(self, file_id):
+        with self.lock:
+            return dict(self._get(file_id))
+
+    """
+    Get the content of a file, or a range of it (end inclusive, as in HTTP).
+    Returns (content, total size).
+    """
+    def get_content(self, file_id, start=None, end=None):
+        with self.lock:
+            file = self._get(file_id)
+            if file['id'] not in self.contents:
+                raise FakeDriveError(403, 'fileNotDownloadable', 'Only files with binary content can be downloaded.')
+            content = self.contents[file['id']]
+        if start is None:
+            return content, len(content)
+        return content[start:end + 1 if end is not None else None], len(content)
+
+    """
+    Delete a file, or a folder and all in it.
+    """
+    def delete(self, file_id):
+        with self.lock:
+            file = self._get(file_id)
+            if file['id'] == ROOT_ID:
+                raise FakeDriveError(403, 'insufficientFilePermissions', 'The root can\'t be deleted.')
+            pending = [ file['id'] ]
+            while pending:
+                id = pending.pop()
+                pending.extend(self.children.pop(id, []))
+                removed = self.files.pop(id)
+                self.contents.pop(id, None)
+                for parent_id in removed['parents']:
+                    if parent_id in self.children:
+                        self.children[parent_id].discard(id)
+                self.changes.append(id)
+
+    def copy(self, file_id, metadata):
+        with self.lock:
+            file = self._get(file_id)
+            if file['id'] not in self.contents:
+                raise FakeDriveError(403, 'cannotCopyFile', 'Folders can\'t be copied.')
+            copy = { 'name': file['name'], 'mimeType': file['mimeType'], 'parents': file['parents'] }
+            copy.update(metadata)
+            return dict(self._add(copy, self.contents.get(file['id'])))
+
+    """
+    Search files.
+    Returns (list of files, next page token or None).
+    """
+    def list(self, q=None, order_by=None, page_size=DEFAULT_PAGE_SIZE, page_token=None):
+        predicate, parents = _QueryParser(q, { 'root': ROOT_ID }).parse() if q else (None, None)
+        with self.lock:
+            if parents is None:
+                candidates = [ file for file in self.files.values() if file['id'] != ROOT_ID ]
+            else:
+                candidates = [ self.files[id] for parent_id in parents for id in self.children.get(parent_id, []) ]
+            files = [ dict(file) for file in candidates if not predicate or predicate(file) ]
+        for key in reversed((order_by or '').split(',')):
+            key = key.strip().split()
+            if not key:
+                continue
+            if key[0] == 'folder':
+                sort_key = lambda file: file['mimeType'] != FOLDER_MIME_TYPE
+            else:
+                sort_key = lambda file: file.get(key[0], '')
+            files.sort(key=sort_key, reverse=len(key) > 1 and key[1] == 'desc')
+        start = int(page_token or 0)
+        end = start + min(page_size, MAX_PAGE_SIZE)
+        return files[start:end], (str(end) if end < len(files) else None)
+
+    def start_page_token(self):
+        with self.lock:
+            return str(len(self.changes))
+
+    """
+    List the changes since a page token.
+    Returns (list of changes, next page token or None, new start page token or None).
+    """
+    def list_changes(self, page_token, page_size=DEFAULT_PAGE_SIZE):
+        with self.lock:
+            start = int(page_token)
+            end = min(len(self.changes), start + min(page_size, MAX_PAGE_SIZE))
+            changes = []
+            for file_id in self.changes[start:end]:
+                file = self.files.get(file_id)
+                change = { 'kind': 'drive#change', 'changeType': 'file', 'fileId': file_id,
+                    'removed': file is None, 'time': _now() }
+                if file is not None:
+                    change['file'] = dict(file)
+                changes.append(change)
+            if end < len(self.changes):
+                return changes, str(end), None
+            return changes, None, str(end)
+
+    """
+    Start a resumable upload.
+    Returns the upload id.
+    """
+    def start_upload(self, metadata, total, fields):
+        with self.lock:
+            upload_id = uuid.uuid4().hex
+            self.uploads[upload_id] = { 'metadata': metadata, 'data': bytearray(), 'total': total,
+                'fields': fields }
+            return upload_id
+
+    """
+    Add a chunk to a resumable upload. start is where the chunk goes (None if
+    it's just a status query), total the size if now known.
+    Returns (bytes received, file if complete, its fields).
+    """
+    def put_upload(self, upload_id, start, chunk, total):
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+            if upload is None:
+                raise FakeDriveError(404, 'notFound', 'Upload session not found.')
+            data = upload['data']
+            if start is not None:
+                if start > len(data):
+                    raise FakeDriveError(400, 'badContent', 'Chunk past the received data.')
+                del data[start:]
+                data.extend(chunk)
+            if total is not None:
+                upload['total'] = total
+            if upload['total'] is None or len(data) < upload['total']:
+                return len(data), None, None
+            del self.uploads[upload_id]
+            return len(data), dict(self._add(upload['metadata'], data)), upload['fields']
+
+"""
+Local HTTP stand-in for the Drive v3 API, serving what the project uses:
+files list (with the query subset of Drive._build_query), get, get_media
+(with ranges), create (folders, multipart and resumable uploads), copy and
+delete, changes, and batches of those. It can add latency (seconds per
+request), limit the bandwidth (bytes per second, per request), fail a share of
+the calls with server errors (error_rate) and enforce a quota (calls per
+second, answered with rate limit errors).
+Point the project to it with the PYDRIVE_API_ROOT_URL variable set to url.
+Use as a context manager, or call start() and stop().
+"""
+class FakeDriveServer:
+    def __init__(self, host='127.0.0.1', port=0, latency=0, bandwidth=None, error_rate=0,
+            quota=None, seed=None):
+        self.drive = FakeDrive()
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.quota = quota
+        self.random = random.Random(seed)
+        self.httpd = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.quota_window = (0, 0) # (second, calls in it)
+        self.reset_stats()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer((self.host, self.port), _FakeDriveHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%d/' % (host, port)
+
+    """
+    Get a copy of the counters: 'requests' (HTTP), 'calls' (API calls, each one
+    in a batch and each upload chunk counted), 'errors' (injected),
+    'bytes_received' and 'bytes_sent'.
+    """
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def reset_stats(self):
+        with self.lock:
+            self.counters = { 'requests': 0, 'calls': 0, 'errors': 0, 'bytes_received': 0, 'bytes_sent': 0 }
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    """
+    Decide if an API call fails (see error_rate and quota).
+    """
+    def _injected_error(self):
+        with self.lock:
+            self.counters['calls'] += 1
+            second = int(time.monotonic())
+            calls = self.quota_window[1] + 1 if self.quota_window[0] == second else 1
+            self.quota_window = (second, calls)
+            if self.quota and calls > self.quota:
+                self.counters['errors'] += 1
+                return FakeDriveError(403, 'userRateLimitExceeded', 'User Rate Limit Exceeded')
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.counters['errors'] += 1
+                return FakeDriveError(503, 'backendError', 'Backend Error')
+        return None
+
+    """
+    Handle an API call.
+    Returns (status, dict of headers, content).
+    """
+    def call(self, method, uri, headers, body, base_url):
+        error = self._injected_error()
+        if error:
+            return error.status, { 'Content-Type': 'application/json; charset=UTF-8' }, error.content()
+        try:
+            return self._route(method, uri, headers, body, base_url)
+        except FakeDriveError as e:
+            return e.status, { 'Content-Type': 'application/json; charset=UTF-8' }, e.content()
+
+    def _route(self, method, uri, headers, body, base_url):
+        parsed = urllib.parse.urlsplit(uri)
+        path = urllib.parse.unquote(parsed.path)
+        params = dict(urllib.parse.parse_qsl(parsed.query, keep_blank_values=True))
+        fields = parse_fields(params.get('fields') or DEFAULT_FILE_FIELDS)
+        if path == UPLOAD_PATH:
+            return self._upload(method, params, headers, body, fields, base_url)
+        if not path.startswith(API_PATH):
+            raise FakeDriveError(404, 'notFound', 'Not Found')
+        parts = path[len(API_PATH):].split('/')
+        drive = self.drive
+        if parts == [ 'files' ] and method == 'GET':
+            files, next_token = drive.list(params.get('q'), params.get('orderBy'),
+                int(params.get('pageSize', DEFAULT_PAGE_SIZE)), params.get('pageToken'))
+            result = { 'kind': 'drive#fileList', 'incompleteSearch': False, 'files': files }
+            if next_token:
+                result['nextPageToken'] = next_token
+            if params.get('fields'):
+                return self._json(select_fields(result, fields))
+            return self._json(select_fields(result, { 'kind': None, 'incompleteSearch': None,
+                'nextPageToken': None, 'files': parse_fields(DEFAULT_FILE_FIELDS) }))
+        if parts == [ 'files' ] and method == 'POST':
+            return self._json(select_fields(drive.create(self._parse_json(body)), fields))
+        if len(parts) == 2 and parts[0] == 'files':
+            if method == 'GET' and params.get('alt') == 'media':
+                return self._media(parts[1], headers)
+            if method == 'GET':
+                return self._json(select_fields(drive.get(parts[1]), fields))
+            if method == 'DELETE':
+                drive.delete(parts[1])
+                return 204, {}, b''
+        if len(parts) == 3 and parts[0] == 'files' and parts[2] == 'copy' and method == 'POST':
+            return self._json(select_fields(drive.copy(parts[1], self._parse_json(body)), fields))
+        if parts == [ 'changes', 'startPageToken' ] and method == 'GET':
+            return self._json({ 'kind': 'drive#startPageToken', 'startPageToken': drive.start_page_token() })
+        if parts == [ 'changes' ] and method == 'GET':
+            changes, next_token, new_start_token = drive.list_changes(params['pageToken'],
+                int(params.get('pageSize', DEFAULT_PAGE_SIZE)))
+            result = { 'kind': 'drive#changeList', 'changes': changes }
+            if next_token:
+                result['nextPageToken'] = next_token
+            if new_start_token:
+                result['newStartPageToken'] = new_start_token
+            return self._json(select_fields(result, parse_fields(params['fields']) if 'fields' in params else None))
+        raise FakeDriveError(404, 'notFound', 'Not Found')
+
+    def _json(self, result, status=200, headers=None):
+        return status, dict(headers or {}, **{ 'Content-Type': 'application/json; charset=UTF-8' }), \
+            json.dumps(result).encode()
+
+    def _parse_json(self, body):
+        try:
+            return json.loads(body or b'{}')
+        except ValueError:
+            raise FakeDriveError(400, 'parseError', 'Parse Error')
+
+    def _media(self, file_id, headers):
+        match = re.match(r'bytes=(\d+)-(\d*)$', headers.get('Range') or '')
+        if not match:
+            content, total = self.drive.get_content(file_id)
+            return 200, { 'Content-Type': 'application/octet-stream' }, content
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else None
+        content, total = self.drive.get_content(file_id, start, end)
+        if start >= total and total > 0:
+            return 416, { 'Content-Range': 'bytes */%d' % total }, b''
+        return 206, { 'Content-Type': 'application/octet-stream',
+            'Content-Range': 'bytes %d-%d/%d' % (start, start + len(content) - 1, total) }, content
+
+    def _upload(self, method, params, headers, body, fields, base_url):
+        upload_type = params.get('uploadType')
+        if method == 'POST' and upload_type == 'multipart':
+            metadata, content = self._parse_multipart(headers.get('Content-Type') or '', body)
+            return self._json(select_fields(self.drive.create(metadata, content), fields))
+        if method == 'POST' and upload_type == 'resumable':
+            total = headers.get('X-Upload-Content-Length')
+            upload_id = self.drive.start_upload(self._parse_json(body), int(total) if total else None, fields)
+            return 200, { 'Location': '%s%s?uploadType=resumable&upload_id=%s' % (base_url,
+                UPLOAD_PATH[1:], upload_id), 'Content-Length': '0' }, b''
+        if method == 'PUT' and upload_type == 'resumable' and 'upload_id' in params:
+            match = re.match(r'bytes (?:(\d+)-\d+|\*)/(\d+|\*)$', headers.get('Content-Range') or 'bytes */*')
+            if not match:
+                raise FakeDriveError(400, 'badContent', 'Invalid Content-Range.')
+            start = int(match.group(1)) if match.group(1) is not None else None
+            total = int(match.group(2)) if match.group(2) != '*' else None
+            received, file, file_fields = self.drive.put_upload(params['upload_id'], start, body, total)
+            if file is not None:
+                return self._json(select_fields(file, file_fields))
+            return 308, { 'Range': 'bytes=0-%d' % (received - 1) } if received > 0 else {}, b''
+        raise FakeDriveError(400, 'invalid', 'Unsupported upload.')
+
+    """
+    Split a multipart/related upload into metadata and content.
+    """
+    def _parse_multipart(self, content_type, body):
+        match = re.search(r'boundary="?([^";]+)"?', content_type)
+        if not match:
+            raise FakeDriveError(400, 'badContent', 'Missing boundary.')
+        delimiter = b'--' + match.group(1).encode()
+        # Lines end in CRLF or, from googleapiclient, in LF only
+        start = body.find(delimiter)
+        newline = b'\r\n' if body[start + len(delimiter):start + len(delimiter) + 2] == b'\r\n' else b'\n'
+        parts = (newline + body[start:]).split(newline + delimiter)[1:]
+        if len(parts) < 3:
+            raise FakeDriveError(400, 'badContent', 'Expected metadata and media parts.')
+        contents = []
+        for part in parts[:2]:
+            headers, separator, content = part[len(newline):].partition(newline + newline)
+            if not separator:
+                raise FakeDriveError(400, 'badContent', 'Invalid part.')
+            contents.append(content)
+        return self._parse_json(contents[0]), contents[1]
+
+    """
+    Handle a batch: each part is a whole API call in HTTP format.
+    Returns (status, dict of headers, content).
+    """
+    def batch(self, headers, body, base_url):
+        message = Parser().parsestr('Content-Type: %s\r\n\r\n%s' % (headers.get('Content-Type'),
+            body.decode()))
+        if not message.is_multipart():
+            raise FakeDriveError(400, 'badRequest', 'Batch not in multipart/mixed format.')
+        responses = []
+        for part in message.get_payload():
+            request_line, request = part.get_payload().split('\n', 1)
+            method, uri = request_line.split()[:2]
+            request = Parser().parsestr(request)
+            status, response_headers, content = self.call(method, uri, request,
+                (request.get_payload() or '').encode(), base_url)
+            response_headers.setdefault('Content-Type', 'application/json; charset=UTF-8')
+            response = ''.join([ '%s: %s\r\n' % (name, value) for name, value in response_headers.items() ])
+            responses.append('--%s\r\nContent-Type: application/http\r\nContent-ID: <response-%s>\r\n\r\n'
+                'HTTP/1.1 %d %s\r\n%s\r\n%s\r\n' % (BATCH_BOUNDARY, part['Content-ID'].strip('<>'), status,
+                _FakeDriveHandler.responses.get(status, ('',))[0], response, content.decode()))
+        content = (''.join(responses) + '--%s--\r\n' % BATCH_BOUNDARY).encode()
+        return 200, { 'Content-Type': 'multipart/mixed; boundary=' + BATCH_BOUNDARY }, content
+
+class _FakeDriveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, as the clients expect
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        base_url = 'http://%s/' % (self.headers.get('Host') or '%s:%d' % self.server.server_address[:2])
+        if urllib.parse.urlsplit(self.path).path == BATCH_PATH:
+            try:
+                status, headers, content = fake.batch(self.headers, body, base_url)
+            except FakeDriveError as e:
+                status, headers, content = e.status, { 'Content-Type': 'application/json; charset=UTF-8' }, e.content()
+        else:
+            status, headers, content = fake.call(self.command, self.path, self.headers, body, base_url)
+        if self.command == 'HEAD':
+            content = b''
+        fake._count('requests')
+        fake._count('bytes_received', len(body))
+        fake._count('bytes_sent', len(content))
+        delay = fake.latency
+        if fake.bandwidth:
+            delay += (len(body) + len(content)) / fake.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+        self.send_response(status)
+        for name, value in headers.items():
+            if name != 'Content-Length':
+                self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_HEAD = _handle
+
+USAGE = """
+python fake_drive_server.py [OPTIONS]
+  Serves a fake, in-memory Drive until interrupted. Point upload.py,
+checkdups.py and download.py to it with the PYDRIVE_API_ROOT_URL environment
+variable set to the URL it prints (no login needed, any client secret file).
+  Options:
+    --port N Port to listen at (default: any free one).
+    --latency S Seconds added to every request.
+    --bandwidth B Bytes per second of every request.
+    --error-rate R Share (0 to 1) of the calls failing with server errors.
+    --quota N Calls per second allowed, more get rate limit errors.
+    --seed N Seed of the error injection, for reproducible runs.
+    --mkdir PATH Create a folder (path from the root) at first. Can repeat.
+"""
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage=USAGE)
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--bandwidth', type=float)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--quota', type=int)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--mkdir', action='append', default=[])
+    args = parser.parse_args()
+    server = FakeDriveServer(port=args.port, latency=args.latency, bandwidth=args.bandwidth,
+        error_rate=args.error_rate, quota=args.quota, seed=args.seed)
+    for path in args.mkdir:
+        server.drive.make_path(path)
+    server.start()
+    print('Fake Drive serving at %s' % server.url)
+    print('PYDRIVE_API_ROOT_URL=%s' % server.url)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print(server.stats())
+        server.stop()
+        sys.exit(0)
@@ -0,0 +1,87 @@
+"""
+Raphael Pithan
+2021
+"""
+
+import threading
+
+"""
+In-memory tree of all the folders under a root folder, built from a flat list
+of folders (dicts with 'id', 'name' and 'parents'). It's a snapshot: folders
+created elsewhere after it was built are not known, folders created through
+add() are. Thread-safe.
+"""
+class FolderIndex:
+    def __init__(self, root_id, folders):
+        self.root_id = root_id
+        self.lock = threading.RLock()
+        self.children = { root_id: [] }  # id -> list of dicts with 'id' and 'name'
+        self.names = { root_id: {} }     # id -> { name: id }
+        self.parents = {}                # id -> (parent id, name)
+        by_parent = {}
+        for folder in folders:
+            for parent_id in folder.get('parents') or []:
+                by_parent.setdefault(parent_id, []).append(folder)
+        pending = [ root_id ]
+        while len(pending) > 0:
+            parent_id = pending.pop()
+            for folder in by_parent.get(parent_id, []):
+                if folder['id'] not in self.children:
+                    self.add(folder['id'], parent_id, folder['name'])
+                    pending.append(folder['id'])
+
+    def __len__(self):
+        return len(self.children)
+
+    """
+    Check if a folder is in the index (the root or one of its subfolders).
+    """
+    def contains(self, id):
+        return id in self.children
+
+    """
+    Add a folder to the index (its parent must be in it already).
+    """
+    def add(self, id, parent_id, name):
+        with self.lock:
+            if parent_id not in self.children:
+                return
+            self.children[parent_id].append({ 'id': id, 'name': name })
+            self.names[parent_id].setdefault(name, id)
+            self.children.setdefault(id, [])
+            self.names.setdefault(id, {})
+            self.parents.setdefault(id, (parent_id, name))
+
+    """
+    Get the id of an immediate subdirectory (or None if it doesn't exist).
+    """
+    def get_subdir(self, parent_id, name):
+        with self.lock:
+            return self.names[parent_id].get(name)
+
+    """
+    List all subdirectories of a folder, sorted by name.
+    Returns list of dicts with 'id' and 'name'.
+    """
+    def list_subdirs(self, parent_id):
+        with self.lock:
+            return sorted(self.children[parent_id], key=lambda folder: folder['name'])
+
+    """
+    Get all the indexed folders (except the root) as (id, parent id, name) tuples.
+    """
+    def get_all(self):
+        with self.lock:
+            return [ (id, parent[0], parent[1]) for id, parent in self.parents.items() ]
+
+    """
+    Get the path of a folder relative to the root (or None if not in the index).
+    """
+    def get_path(self, id):
+        if id not in self.children:
+            return None
+        names = []
+        while id != self.root_id:
+            id, name = self.parents[id]
+            names.append(name)
+        return '/'.join(reversed(names))
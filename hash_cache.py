@@ -0,0 +1,99 @@
+"""
+Raphael Pithan
+2021
+"""
+
+import os
+import os.path
+import sqlite3
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+HASH_BLOCK_SIZE = 1024 * 1024
+HASH_CHUNKS_PER_WORKER = 4 # files go to the processes in this many chunks each, at most
+
+"""
+Calculate the MD5 of a file (hex digest, as Drive's md5Checksum).
+"""
+def md5_file(full_file_path):
+    md5 = hashlib.md5()
+    with open(full_file_path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                return md5.hexdigest()
+            md5.update(block)
+
+"""
+Calculate the MD5 of a file, for the pool of processes.
+Returns a tuple with the MD5 (or None) and the error reading the file (or None).
+"""
+def _md5_file_or_error(full_file_path):
+    try:
+        return md5_file(full_file_path), None
+    except OSError as e:
+        return None, str(e)
+
+"""
+Hashes local files in a pool of processes and remembers the results in a
+persistent (SQLite) cache keyed by path, size and mtime, so unchanged files are
+never read again. Thread-safe.
+"""
+class FileHasher:
+    def __init__(self, db_file, num_workers=None):
+        dir = os.path.split(db_file)[0]
+        if dir:
+            os.makedirs(dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, '
+                'size INTEGER, mtime_ns INTEGER, md5 TEXT)')
+        # Spawned, not forked: the processes start on demand, when the program
+        # already runs other threads
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(self.num_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def close(self):
+        self.pool.shutdown()
+        with self.lock:
+            self.db.close()
+
+    """
+    Get the size and MD5 of many files. Files that can't be read (e.g. removed
+    meanwhile) are skipped, with a warning.
+    Returns dict of path -> (size, md5).
+    """
+    def hash_files(self, full_file_paths):
+        results = {}
+        to_hash = []
+        with self.lock:
+            for path in full_file_paths:
+                try:
+                    stat = os.stat(path)
+                except OSError as e:
+                    print('Warning: skipping "%s" (%s)' % (path, e))
+                    continue
+                row = self.db.execute('SELECT md5 FROM hashes WHERE path=? AND size=? AND mtime_ns=?',
+                    (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)).fetchone()
+                if row:
+                    results[path] = (stat.st_size, row[0])
+                else:
+                    to_hash.append((path, stat))
+        # Hashed without the lock, so other threads can use the cache meanwhile
+        chunk_size = max(1, len(to_hash) // (self.num_workers * HASH_CHUNKS_PER_WORKER))
+        md5s = list(self.pool.map(_md5_file_or_error, [ path for path, stat in to_hash ],
+            chunksize=chunk_size))
+        with self.lock, self.db:
+            for i in range(len(to_hash)):
+                path, stat = to_hash[i]
+                md5, error = md5s[i]
+                if error:
+                    print('Warning: skipping "%s" (%s)' % (path, error))
+                    continue
+                self.db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)',
+                    (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, md5))
+                results[path] = (stat.st_size, md5)
+        return results
@@ -0,0 +1,198 @@
+"""
+Raphael Pithan
+2021
+"""
+
+import os
+import os.path
+import sqlite3
+import threading
+import time
+
+DEFAULT_MAX_AGE = 24 * 60 * 60 # seconds
+LISTING_DIRS = 'dirs'
+LISTING_FILES = 'files'
+FILE_FIELDS = [ 'id', 'name', 'size', 'md5Checksum' ]
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+"""
+Persistent (SQLite) cache of Drive metadata: folders (id, parent, name), files
+(id, parent, name, size, md5) and which folders had their contents listed
+completely. Entries older than max_age seconds are ignored. Thread-safe, the
+same instance can be shared among Drive instances.
+"""
+class MetadataCache:
+    def __init__(self, db_file, max_age=DEFAULT_MAX_AGE):
+        dir = os.path.split(db_file)[0]
+        if dir:
+            os.makedirs(dir, exist_ok=True)
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS folders (id TEXT, parent_id TEXT, '
+                'name TEXT, updated REAL, PRIMARY KEY (id, parent_id))')
+            self.db.execute('CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent_id, name)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS files (id TEXT, parent_id TEXT, '
+                'name TEXT, size INTEGER, md5 TEXT, updated REAL, PRIMARY KEY (id, parent_id))')
+            self.db.execute('CREATE INDEX IF NOT EXISTS files_parent ON files (parent_id)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS listings (parent_id TEXT, kind TEXT, '
+                'fields TEXT, updated REAL, PRIMARY KEY (parent_id, kind))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def _min_time(self):
+        return time.time() - self.max_age
+
+    """
+    Get a value stored in the cache's state table (or None).
+    """
+    def get_state(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM state WHERE key=?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key, value):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (key, value))
+
+    """
+    Drop every cached folder, file and listing (the state is kept).
+    """
+    def clear(self):
+        with self.lock, self.db:
+            for table in [ 'folders', 'files', 'listings' ]:
+                self.db.execute('DELETE FROM %s' % table)
+
+    """
+    Get the id of an immediate subdirectory (or None if it isn't cached).
+    """
+    def get_subdir(self, parent_id, name):
+        with self.lock:
+            row = self.db.execute('SELECT id FROM folders WHERE parent_id=? AND name=? '
+                'AND updated>=?', (parent_id, name, self._min_time())).fetchone()
+        return row[0] if row else None
+
+    def add_folder(self, id, parent_id, name):
+        self.add_folders([ (id, parent_id, name) ])
+
+    """
+    Add many folders at once, as (id, parent id, name) tuples.
+    """
+    def add_folders(self, folders):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?)',
+                [ (id, parent_id, name, now) for id, parent_id, name in folders ])
+
+    """
+    Add a file. If its folder had been listed, the listing stays complete.
+    """
+    def add_file(self, id, parent_id, name, size=None, md5=None):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                (id, parent_id, name, _int_or_none(size), md5, time.time()))
+
+    """
+    Remove a file or folder (from all its parents).
+    """
+    def remove(self, id):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM folders WHERE id=?', (id,))
+            self.db.execute('DELETE FROM files WHERE id=?', (id,))
+            self.db.execute('DELETE FROM listings WHERE parent_id=?', (id,))
+
+    """
+    Get the complete listing of a folder's subdirectories or files, as lists
+    of dicts sorted by name like the API returns them (or None if the folder
+    wasn't listed, the listing expired or lacks some of the requested fields).
+    """
+    def get_listing(self, parent_id, kind, fields=('id', 'name')):
+        with self.lock:
+            row = self.db.execute('SELECT fields FROM listings WHERE parent_id=? AND kind=? '
+                'AND updated>=?', (parent_id, kind, self._min_time())).fetchone()
+            if not row or not set(fields).issubset(row[0].split(',')):
+                return None
+            if kind == LISTING_DIRS:
+                rows = self.db.execute('SELECT id, name FROM folders WHERE parent_id=? '
+                    'ORDER BY name', (parent_id,)).fetchall()
+                return [ { 'id': r[0], 'name': r[1] } for r in rows ]
+            rows = self.db.execute('SELECT id, name, size, md5 FROM files WHERE parent_id=? '
+                'ORDER BY name', (parent_id,)).fetchall()
+        return [ _file_entry(r, fields) for r in rows ]
+
+    """
+    Store the complete listing of a folder's subdirectories or files (lists of
+    dicts as returned by the API), replacing what was cached for it.
+    """
+    def set_listing(self, parent_id, kind, entries, fields=('id', 'name')):
+        now = time.time()
+        table = 'folders' if kind == LISTING_DIRS else 'files'
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM %s WHERE parent_id=?' % table, (parent_id,))
+            if kind == LISTING_DIRS:
+                self.db.executemany('INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?)',
+                    [ (e['id'], parent_id, e['name'], now) for e in entries ])
+            else:
+                self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                    [ (e['id'], parent_id, e['name'], _int_or_none(e.get('size')),
+                        e.get('md5Checksum'), now) for e in entries ])
+            self.db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)',
+                (parent_id, kind, ','.join(fields), now))
+
+    """
+    Apply entries of the Drive changes feed (dicts with 'fileId', 'removed' and
+    'file'): removed or trashed items are dropped, the others are (re)placed
+    under their current parents.
+    """
+    def apply_changes(self, changes):
+        now = time.time()
+        with self.lock, self.db:
+            for change in changes:
+                id = change.get('fileId')
+                file = change.get('file')
+                self.db.execute('DELETE FROM folders WHERE id=?', (id,))
+                self.db.execute('DELETE FROM files WHERE id=?', (id,))
+                if change.get('removed') or not file or file.get('trashed'):
+                    self.db.execute('DELETE FROM listings WHERE parent_id=?', (id,))
+                    continue
+                for parent_id in file.get('parents') or []:
+                    if file.get('mimeType') == FOLDER_MIME_TYPE:
+                        self.db.execute('INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?)',
+                            (id, parent_id, file.get('name'), now))
+                    else:
+                        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                            (id, parent_id, file.get('name'), _int_or_none(file.get('size')),
+                                file.get('md5Checksum'), now))
+
+    """
+    Renew the validity of every entry stored since the given time. Used once
+    all changes up to the given time were applied, as those entries are then
+    known to be up to date.
+    """
+    def revalidate(self, since, now):
+        with self.lock, self.db:
+            for table in [ 'folders', 'files', 'listings' ]:
+                self.db.execute('UPDATE %s SET updated=? WHERE updated>=?' % table, (now, since))
+
+"""
+Split an API 'fields' string for files (e.g. 'id, name') into a list, or None
+if some field can't be served by the cache.
+"""
+def parse_file_fields(fields):
+    fields = [ f.strip() for f in fields.split(',') ]
+    return fields if set(fields).issubset(FILE_FIELDS) else None
+
+def _file_entry(row, fields):
+    entry = { 'id': row[0], 'name': row[1] }
+    if 'size' in fields and row[2] is not None:
+        entry['size'] = str(row[2]) # the API returns it as a string
+    if 'md5Checksum' in fields and row[3] is not None:
+        entry['md5Checksum'] = row[3]
+    return entry
+
+def _int_or_none(value):
+    return int(value) if value is not None else None
@@ -0,0 +1,118 @@
+"""
+Raphael Pithan
+2021
+"""
+
+import json
+import time
+import tarfile
+import hashlib
+import itertools
+import threading
+
+PACK_PREFIX = '_pack_'
+PACK_SUFFIX = '.tar'
+PACK_INDEX_SUFFIX = '.tar.index.json'
+
+_pack_counter = itertools.count()
+_pack_counter_lock = threading.Lock()
+
+"""
+Make a new (unique) pack name, without suffix.
+"""
+def make_pack_name():
+    with _pack_counter_lock:
+        number = next(_pack_counter)
+    return '%s%s_%04d' % (PACK_PREFIX, time.strftime('%Y%m%d%H%M%S'), number)
+
+"""
+Check if a Drive file name is of a pack index.
+"""
+def is_pack_index(name):
+    return name.startswith(PACK_PREFIX) and name.endswith(PACK_INDEX_SUFFIX)
+
+"""
+Collects what tarfile writes, to be taken out in chunks.
+"""
+class _ChunkCollector:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+"""
+Reader which feeds what's read through a hash.
+"""
+class _HashingReader:
+    def __init__(self, file, hash):
+        self.file = file
+        self.hash = hash
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.hash.update(data)
+        return data
+
+"""
+Bundles local files into a tar archive produced as a stream (see stream()), so
+it can be uploaded while it's made, with no temp file and holding about one
+file in memory. The index maps each file name to where its content is in the
+archive: 'offset' (of the data), 'size' and 'md5', so a single file can be
+read back with a ranged download (see read_packed_file).
+"""
+class PackWriter:
+    def __init__(self, files):
+        self.files = files # list of (name in the pack, full file path)
+        self.index = { 'archive': None, 'files': {} }
+        self.size = 0 # of the archive, so far
+        self.md5 = hashlib.md5() # of the archive, so far
+
+    """
+    Generate the archive's content, in chunks. The index, size and md5 are
+    complete when it ends.
+    """
+    def stream(self):
+        for chunk in self._stream_chunks():
+            if chunk: # tarfile holds data back until a record is full
+                self.size += len(chunk)
+                self.md5.update(chunk)
+                yield chunk
+
+    def _stream_chunks(self):
+        collector = _ChunkCollector()
+        tar = tarfile.open(fileobj=collector, mode='w|', format=tarfile.PAX_FORMAT)
+        for name, full_file_path in self.files:
+            info = tar.gettarinfo(full_file_path, arcname=name)
+            md5 = hashlib.md5()
+            with open(full_file_path, 'rb') as f:
+                tar.addfile(info, _HashingReader(f, md5))
+            padded_size = (info.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+            self.index['files'][name] = { 'offset': tar.offset - padded_size, 'size': info.size,
+                'md5': md5.hexdigest() }
+            yield collector.take()
+        tar.close()
+        yield collector.take()
+
+    """
+    Get the index as the content of an index file, given the archive's file id.
+    """
+    def index_content(self, archive_id):
+        self.index['archive'] = archive_id
+        return json.dumps(self.index).encode()
+
+"""
+Read a single file out of a pack on the Drive, given its parsed index, with a
+ranged download of just its content.
+Returns the content.
+"""
+def read_packed_file(drive, index, name):
+    entry = index['files'][name]
+    if entry['size'] == 0:
+        return b''
+    return drive.download_range(index['archive'], entry['offset'], entry['offset'] + entry['size'])
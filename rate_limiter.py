@@ -0,0 +1,124 @@
+"""
+Raphael Pithan
+2021
+"""
+
+import time
+import random
+import threading
+
+MAX_REQUEST_RATE = 200     # requests per second, about the default per-user quota
+REQUEST_RATE = MAX_REQUEST_RATE # at first, lowered by the first quota error
+MIN_REQUEST_RATE = 0.5
+REQUEST_BURST = 20          # requests that can go at once after idling
+RATE_DECREASE_FACTOR = 0.5  # on each quota error
+RATE_INCREASE_FACTOR = 1.01 # on each success (doubles in about 70 requests)
+BACKOFF_BASE = 1            # seconds
+BACKOFF_MAX = 64            # seconds
+RATE_LIMIT_MAX_RETRIES = 8
+RATE_LIMIT_REASONS = [ 'userRateLimitExceeded', 'rateLimitExceeded' ]
+
+"""
+Check if an error response means a quota was exceeded (429, or 403 with a rate
+limit reason), as opposed to a real failure.
+"""
+def is_rate_limit_error(status, content):
+    if status == 429:
+        return True
+    if status != 403 or not content:
+        return False
+    if isinstance(content, bytes):
+        content = content.decode(errors='replace')
+    return any(reason in content for reason in RATE_LIMIT_REASONS)
+
+"""
+Get how long to wait before a retry: what the server asked for in Retry-After
+(seconds), or exponential backoff, both with random jitter so the workers
+don't all come back at the same time.
+"""
+def retry_delay(retry, retry_after=None):
+    if retry_after is not None:
+        try:
+            return float(retry_after) + random.uniform(0, BACKOFF_BASE)
+        except ValueError:
+            pass # HTTP date, not sent by Drive
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** retry))
+
+"""
+Token bucket limiting the request rate of everything that shares it (all Drive
+instances made by duplicate_service(), and AsyncDrive). The rate adapts to the
+quota: it starts at the usual quota, is halved on quota errors and raised by a
+small factor on each success, so it stays right under the limit instead of
+stalling on it. Thread-safe.
+"""
+class RateLimiter:
+    def __init__(self, rate=REQUEST_RATE, burst=REQUEST_BURST, max_rate=MAX_REQUEST_RATE):
+        self.rate = rate
+        self.burst = burst
+        self.max_rate = max_rate
+        self.tokens = burst
+        self.last_time = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    """
+    Take tokens from the bucket (it may go into debt).
+    Returns how long to wait, in seconds, before making the requests.
+    """
+    def reserve(self, num_requests=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            self.tokens -= num_requests
+            return max(0, -self.tokens / self.rate, self.paused_until - now)
+
+    """
+    Wait until the requests can be made.
+    """
+    def acquire(self, num_requests=1):
+        delay = self.reserve(num_requests)
+        if delay > 0:
+            time.sleep(delay)
+
+    """
+    Report a successful request.
+    """
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate * RATE_INCREASE_FACTOR)
+
+    """
+    Report a quota error: everyone pauses for delay seconds and the rate drops.
+    Errors arriving during the pause are the same event and don't drop it again.
+    """
+    def throttled(self, delay):
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.paused_until:
+                self.rate = max(MIN_REQUEST_RATE, self.rate * RATE_DECREASE_FACTOR)
+            self.paused_until = max(self.paused_until, now + delay)
+
+"""
+Wrapper of an httplib2-like Http object (as used by googleapiclient) which
+goes through a RateLimiter, and retries the requests that hit a quota.
+Everything else is passed through to the wrapped object.
+"""
+class RateLimitedHttp:
+    def __init__(self, http, rate_limiter):
+        self.http = http
+        self.rate_limiter = rate_limiter
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        for retry in range(RATE_LIMIT_MAX_RETRIES + 1):
+            self.rate_limiter.acquire()
+            resp, content = self.http.request(uri, method, body, headers, *args, **kwargs)
+            if retry < RATE_LIMIT_MAX_RETRIES and is_rate_limit_error(resp.status, content):
+                self.rate_limiter.throttled(retry_delay(retry, resp.get('retry-after')))
+                continue
+            if resp.status < 400:
+                self.rate_limiter.succeeded()
+            return resp, content
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
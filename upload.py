@@ -15,15 +15,18 @@ import sys
 import time
 import argparse
 import signal
+import json
+import builtins
 import threading
-import tkinter as tk
-from tkinter import filedialog
-from tkinter import simpledialog
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+# The Google API, tkinter and hashing modules take a while to load, they are
+# imported only when needed, so a run with nothing to do ends fast
 from auxiliar import *
-from drive import *
-from work_queue import Dispatcher, Worker
+from pack import PackWriter, make_pack_name, is_pack_index, PACK_SUFFIX, PACK_INDEX_SUFFIX
+from work_queue import Dispatcher, Worker, SCHEDULE_FIFO, SCHEDULE_POLICIES
 from concurrent_progress_bar import ConcurrentProgressBar as ProgressBar
 
 #===============================================================================
@@ -32,7 +35,20 @@ from concurrent_progress_bar import ConcurrentProgressBar as ProgressBar
 # Configurable ----
 
 MAX_CONCURRENT_UPLOADS = 4
+LIST_FILES_GROUP = 25 # directories whose destination is listed at once
+PREFETCH_WORKERS = 2
+PREFETCH_GROUPS_AHEAD = 4 # groups of directories prepared ahead of the uploads
+SCHEDULE_LOOKAHEAD = 64 # files the scheduling policy chooses from
 LAST_EXECUTION_LOG = 'log/run%s.log'
+METADATA_CACHE_FILE = 'cache/metadata.db'
+METADATA_CACHE_MAX_AGE = 24 * 60 * 60 # seconds
+UPLOAD_JOURNAL_FILE = 'cache/uploads.json'
+HASH_CACHE_FILE = 'cache/hashes.db'
+STDIN_READ_SIZE = 256 * 1024
+PACK_FILE_MAX_SIZE = 100 * 1024 # pack mode: files up to this size are packed
+PACK_MAX_SIZE = 64 * 1024 * 1024 # content per pack
+PACK_MAX_FILES = 10000
+PACK_MIN_FILES = 8 # fewer are uploaded as they are
 DONT_UPLOAD_EXTENSIONS = [
     '.db', '.py', '.bat'
 ]
@@ -47,16 +63,16 @@ DEBUG_DRY_RUN = False
 
 # Log -------------
 
-try:
-    os.makedirs(os.path.split(LAST_EXECUTION_LOG)[0])
-except:
-    pass
-f = open(LAST_EXECUTION_LOG % datetime.now().strftime("%Y%m%d%H%M%S%f"), 'wt')
+g_log_file = None # opened on the first print
 def print2(*args, **kwargs):
-    __builtins__.print(*args, **kwargs)
+    global g_log_file
+    builtins.print(*args, **kwargs)
+    if g_log_file is None:
+        os.makedirs(os.path.split(LAST_EXECUTION_LOG)[0], exist_ok=True)
+        g_log_file = open(LAST_EXECUTION_LOG % datetime.now().strftime("%Y%m%d%H%M%S%f"), 'wt')
     endl = '\n' if not 'end' in kwargs else kwargs['end']
-    f.write('\t'.join(args))
-    f.write(endl)
+    g_log_file.write('\t'.join(args))
+    g_log_file.write(endl)
 print = print2
 
 #===============================================================================
@@ -76,6 +92,8 @@ g_tk_root = None
 Open a file dialog for selecting a directory.
 """
 def ask_for_source(initial=None):
+    import tkinter as tk
+    from tkinter import filedialog
     global g_tk_root
     if not g_tk_root:
         g_tk_root = tk.Tk()
@@ -87,6 +105,8 @@ def ask_for_source(initial=None):
 Open a text dialog prompt for typing the name of the destination directory.
 """
 def ask_for_dest(initial):
+    import tkinter as tk
+    from tkinter import simpledialog
     global g_tk_root
     if not g_tk_root:
         g_tk_root = tk.Tk()
@@ -156,6 +176,197 @@ def debug_pretend_upload(file, callback):
         uploaded += rate
         callback(min(uploaded, total), total)
 
+"""
+Walk the source directories (skipping the excluded ones) in groups of up to
+LIST_FILES_GROUP.
+"""
+def walk_dir_groups(source_root, options):
+    group = []
+    for path, dirs, files in os.walk(source_root):
+        if check_dir_excluded(path, options, root=source_root):
+            print('Directory "%s" excluded from upload' % path)
+            continue
+        group.append({ 'path': path, 'files': files })
+        if len(group) >= LIST_FILES_GROUP:
+            yield group
+            group = []
+    if len(group) > 0:
+        yield group
+
+"""
+Walk the source directories and prepare their destination in groups: the
+destination directories are created as needed and the files already in them
+are listed all at once. A small pool of threads (with their own Drive
+instances) prepares up to PREFETCH_GROUPS_AHEAD groups ahead of the caller, so
+the uploads don't wait on those round trips.
+Yields a dict per directory, in walk order, with its 'path', 'files',
+'relative_path', 'dest_path', 'dest_id', 'existing_files_map',
+'changed_files_map' (see compare_checksums) and 'hashes' (see
+set_existing_files).
+"""
+def walk_prepared_dirs(drive, source_root, dest_root, dest_root_id, options, hasher=None):
+    if options['async']:
+        # Each group is prepared concurrently, on an event loop thread
+        from async_drive import AsyncDrive, AsyncRunner
+        runner = AsyncRunner()
+        async_drive = AsyncDrive(drive)
+        runner.run(async_drive.open())
+        submit = lambda group: runner.submit(prepare_dirs_async(async_drive, group,
+            source_root, dest_root, dest_root_id, hasher, options['copy_duplicates'], options['checksum']))
+    else:
+        thread_data = threading.local()
+        def prepare(group):
+            if not hasattr(thread_data, 'drive'):
+                thread_data.drive = drive.duplicate_service()
+            return prepare_dirs(thread_data.drive, group, source_root, dest_root, dest_root_id,
+                hasher, options['copy_duplicates'], options['checksum'])
+        pool = ThreadPoolExecutor(PREFETCH_WORKERS)
+        submit = lambda group: pool.submit(prepare, group)
+    pending = collections.deque()
+    try:
+        for group in walk_dir_groups(source_root, options):
+            pending.append(submit(group))
+            if len(pending) > PREFETCH_GROUPS_AHEAD:
+                yield from pending.popleft().result()
+        while len(pending) > 0:
+            yield from pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        if options['async']:
+            runner.run(async_drive.close())
+            runner.stop()
+        else:
+            pool.shutdown()
+
+"""
+Decide which files of a source directory already exist in its destination by
+content (size and MD5), given the destination's files (with 'size' and
+'md5Checksum') and the local files' sizes and MD5s. Files with the same content
+as any destination file are existing, even if renamed; files whose name is
+taken by a different content are changed, and replace the destination file.
+Sets the directory's 'existing_files_map' and 'changed_files_map'.
+"""
+def compare_checksums(dir, remote_files, local_hashes):
+    remote_names = set([ file['name'] for file in remote_files ])
+    remote_contents = set([ (int(file['size']), file['md5Checksum']) for file in remote_files
+        if 'size' in file and 'md5Checksum' in file ])
+    # Without an MD5 (e.g. Google Docs) the contents are unknown: never replaced
+    unknown_names = set([ file['name'] for file in remote_files
+        if 'size' not in file or 'md5Checksum' not in file ])
+    dir['existing_files_map'] = {}
+    dir['changed_files_map'] = {}
+    for file in dir['files']:
+        content = local_hashes.get(clean_path(dir['path'] + '/' + file))
+        if content in remote_contents:
+            dir['existing_files_map'][file] = True
+        elif file in unknown_names or (content is None and file in remote_names):
+            dir['existing_files_map'][file] = True # can't compare, kept by name
+        elif file in remote_names:
+            dir['changed_files_map'][file] = True
+
+"""
+Set what exists in the destination directories of a group (see
+walk_prepared_dirs), by name or, with by_content, by content. Local hashes are
+kept in the directory's 'hashes' (all of them with hash_all, e.g. to find
+copy sources, which doesn't change what exists).
+"""
+def set_existing_files(group, listings, hasher, hash_all=False, by_content=False):
+    for dir in group:
+        remote_files = listings.get(dir['dest_id']) or []
+        dir['hashes'] = {}
+        dir['by_content'] = by_content and len(remote_files) > 0
+        if hasher and (dir['by_content'] or hash_all):
+            dir['hashes'] = hasher.hash_files([ clean_path(dir['path'] + '/' + file)
+                for file in dir['files'] ])
+        if dir['by_content']:
+            compare_checksums(dir, remote_files, dir['hashes'])
+        else:
+            dir['existing_files_map'] = result_list_to_map(remote_files)
+            dir['changed_files_map'] = {}
+
+"""
+Find the pack indexes (see --pack) among the destination files of a group.
+Returns list of (dir, index file id).
+"""
+def find_pack_indexes(group, listings):
+    return [ (dir, file['id']) for dir in group for file in listings.get(dir['dest_id']) or []
+        if is_pack_index(file['name']) ]
+
+"""
+Add the files of a pack (given its index) to the existing ones of a directory:
+by name or, if it's compared by content, by content.
+"""
+def add_packed_files(dir, index):
+    for file, entry in index['files'].items():
+        content = dir['hashes'].get(clean_path(dir['path'] + '/' + file)) if dir['by_content'] else None
+        if not content or content == (entry['size'], entry['md5']):
+            dir['existing_files_map'][file] = True
+            dir['changed_files_map'].pop(file, None)
+
+"""
+Prepare the destination of a group of source directories (see walk_prepared_dirs).
+"""
+def prepare_dirs(drive, group, source_root, dest_root, dest_root_id, hasher=None, hash_all=False,
+        by_content=False):
+    for dir in group:
+        dir['relative_path'] = make_relative_path(dir['path'], source_root)
+        dir['dest_path'] = clean_path(dest_root + '/' + dir['relative_path'])
+        dir['dest_id'] = drive.get_subpath(dest_root_id, dir['relative_path'], create=True)
+    to_list = [ dir for dir in group if len(dir['files']) > 0 ]
+    for dir in to_list:
+        print('Listing files for "%s"...' % dir['dest_path'])
+    listings = drive.list_files_multi([ dir['dest_id'] for dir in to_list ],
+        fields='id, name, size, md5Checksum' if hasher else 'id, name')
+    set_existing_files(group, listings, hasher, hash_all, by_content)
+    for dir, index_id in find_pack_indexes(group, listings):
+        add_packed_files(dir, json.loads(drive.download_file(index_id).getvalue()))
+    return group
+
+"""
+Same as prepare_dirs, through an AsyncDrive: all the directories of the group
+are resolved and listed concurrently.
+"""
+async def prepare_dirs_async(drive, group, source_root, dest_root, dest_root_id, hasher=None,
+        hash_all=False, by_content=False):
+    import asyncio
+    for dir in group:
+        dir['relative_path'] = make_relative_path(dir['path'], source_root)
+        dir['dest_path'] = clean_path(dest_root + '/' + dir['relative_path'])
+    dest_ids = await asyncio.gather(*[ drive.get_subpath(dest_root_id, dir['relative_path'],
+        create=True) for dir in group ])
+    for i in range(len(group)):
+        group[i]['dest_id'] = dest_ids[i]
+    to_list = [ dir for dir in group if len(dir['files']) > 0 ]
+    for dir in to_list:
+        print('Listing files for "%s"...' % dir['dest_path'])
+    fields = 'id, name, size, md5Checksum' if hasher else 'id, name'
+    listings = await asyncio.gather(*[ drive.list_files(dir['dest_id'], fields=fields)
+        for dir in to_list ])
+    listings = { to_list[i]['dest_id']: listings[i] for i in range(len(to_list)) }
+    await asyncio.get_running_loop().run_in_executor(None, set_existing_files,
+        group, listings, hasher, hash_all, by_content)
+    indexes = find_pack_indexes(group, listings)
+    contents = await asyncio.gather(*[ drive.download_file(index_id) for dir, index_id in indexes ])
+    for i in range(len(indexes)):
+        add_packed_files(indexes[i][0], json.loads(contents[i].getvalue()))
+    return group
+
+"""
+Map the content (size, MD5) of every file under the destination root to the
+id of one of those files. Needs the folder index of the destination: only its
+folders are listed.
+"""
+def map_remote_contents(drive):
+    index = drive.folder_index
+    folder_ids = [ index.root_id ] + [ id for id, parent_id, name in index.get_all() ]
+    contents = {}
+    for files in drive.list_files_multi(folder_ids, fields='id, size, md5Checksum').values():
+        for file in files:
+            if 'size' in file and 'md5Checksum' in file:
+                contents.setdefault((int(file['size']), file['md5Checksum']), file['id'])
+    return contents
+
 """
 Main. See script's doc bellow for more information.
 """
@@ -171,6 +382,7 @@ def main(source_root, dest_root, options):
         if not check_dir_excluded(path, options, root=source_root):
             num_source_files += len(files)
     print('%d files found' % num_source_files)
+    profile_mark('source files counted')
     if num_source_files == 0:
         sys.exit(0)
     
@@ -179,10 +391,21 @@ def main(source_root, dest_root, options):
     if not secret_file:
         print('No client secret file found!')
         sys.exit(1)
+    from drive import Drive
+    from metadata_cache import MetadataCache
+    from upload_journal import UploadJournal
+    profile_mark('Drive modules loaded')
     print('Connecting to Google Drive... ', end='')
-    drive = Drive()
+    cache = MetadataCache(METADATA_CACHE_FILE, METADATA_CACHE_MAX_AGE) if options['cache'] else None
+    drive = Drive(cache=cache, upload_journal=UploadJournal(UPLOAD_JOURNAL_FILE))
     drive.connect(secret_file)
     print('CONNECTED')
+    profile_mark('connected')
+    
+    cold_cache = not cache or not cache.get_state('changes_token')
+    if cache:
+        print('Refreshing the metadata cache... ', end='')
+        print('%d change(s)' % drive.refresh_cache())
     
     print('Searching for the destination path in your Drive... ', end='')
     dest_root_id = drive.get_path(dest_root)
@@ -190,20 +413,45 @@ def main(source_root, dest_root, options):
         print('\nERROR: path "%s" not found in your Drive' % dest_root)
         sys.exit(1)
     print('FOUND (%s)' % dest_root_id)
+    profile_mark('destination found')
+    
+    hasher = None
+    if options['checksum'] or options['copy_duplicates']:
+        from hash_cache import FileHasher
+        hasher = FileHasher(HASH_CACHE_FILE)
+    
+    if cold_cache or options['copy_duplicates']:
+        # A warm cache resolves the paths already, indexing would cost more
+        print('Indexing the destination folders... ', end='')
+        print('%d folder(s)' % len(drive.build_folder_index(dest_root_id)))
+    
+    remote_contents = {}
+    if options['copy_duplicates']:
+        print('Indexing the destination files by content... ', end='')
+        remote_contents = map_remote_contents(drive)
+        print('%d file(s)' % len(remote_contents))
     
     # Show confirmation
     print('\n--The following operation will be executed--')
     print('Copy up to %d files from\n  >>>"%s"<<<' % (num_source_files, source_root))
     print('to your Google Drive path\n  >>>"%s"<<<.' % dest_root)
-    print('Existing files will be skipped.')
+    if options['checksum']:
+        print('Files whose content already exists will be skipped, changed files replaced.')
+    else:
+        print('Existing files will be skipped.')
     if DEBUG_DRY_RUN:
         print('## THIS IS A DRY RUN, NO UPLOADS WILL BE MADE ##')
+    if options['copy_duplicates']:
+        print('Files whose content is elsewhere in the destination will be copied there.')
+    if options['pack']:
+        print('Small files will be uploaded in packs (archives with an index).')
     print('Operation can be interrupted at any time by >>>Ctrl+C<<<.')
     if not DEBUG_SKIP_CONFIRMATION and not options['skip_confirmation'] and input('Are you sure [y/N]? ').upper() != 'Y':
         print('Operation aborted!')
         sys.exit(1)
     
     # --- It's show time ---
+    profile_mark('ready to upload')
     print(datetime.now().strftime("%d/%m/%Y %H:%M:%S"))
     
     global g_stop_loop
@@ -218,13 +466,14 @@ def main(source_root, dest_root, options):
         'size_uploaded_files': 0,
         'num_uploaded_files': 0,
         'num_upload_errors': 0,
+        'num_copied_files': 0,
+        'num_packs': 0,
         'num_existing_files': 0,
         'num_skipped_files': 0,
         'num_processed_files': 0,
         'error_streak': 0,
     }
-    ERROR_STREAK_WAIT = 5
-    ERROR_STREAK_ABORT = 10
+    ERROR_STREAK_ABORT = 10 # quota errors are retried by the Drive's rate limiter, these are real
     
     # Work queue
     def upload_task(data):
@@ -234,17 +483,46 @@ def main(source_root, dest_root, options):
         my_drive = g_thread_data[tid]['drive']
         
         g_progress_bar.clear()
-        print('[%d] uploading file "%s/%s" (%s)' % (tid, file_data['dest_path'],
-            file_data['file'], format_pretty_size(file_data['file_size'])))
+        if file_data['pack']:
+            print('[%d] uploading pack "%s/%s" (%d files, %s)' % (tid, file_data['dest_path'],
+                file_data['file'], len(file_data['pack']), format_pretty_size(file_data['file_size'])))
+        elif file_data['copy_from']:
+            print('[%d] copying file "%s/%s" (%s) from a duplicate' % (tid, file_data['dest_path'],
+                file_data['file'], format_pretty_size(file_data['file_size'])))
+        else:
+            print('[%d] uploading file "%s/%s" (%s)' % (tid, file_data['dest_path'],
+                file_data['file'], format_pretty_size(file_data['file_size'])))
         g_progress_bar.redraw()
         
+        if file_data['copy_from']:
+            try:
+                if not DEBUG_DRY_RUN:
+                    _, file_data['current_dest_id'] = my_drive.run_in_folder(file_data['dest_path'],
+                        file_data['current_dest_id'], lambda dest_id: my_drive.copy_file(
+                            file_data['copy_from'], dest_id, file_data['file'], replace=file_data['replace']))
+                with shared_data['lock']:
+                    shared_data['num_copied_files'] += 1
+                    shared_data['num_processed_files'] += 1
+                    shared_data['error_streak'] = 0
+                return
+            except Exception as e:
+                print('**File copy error, uploading instead: ' + str(e))
+        
+        if file_data['pack']:
+            return upload_pack_task(data)
+
         try:
-            callback = lambda progress, total: (g_progress_bar.update_part(tid, progress, total),
+            callback = lambda progress, total, chunk_size=None: (g_progress_bar.update_part(tid, progress, total),
                 g_progress_bar.update_total(shared_data['num_processed_files'], num_source_files))
                 
             if not DEBUG_DRY_RUN:
-                my_drive.upload_file(file_data['current_dest_id'], file_data['full_file_path'],
-                    progress_callback=callback, check_exists=False, replace=options['replace'])
+                file_id, file_data['current_dest_id'] = my_drive.run_in_folder(file_data['dest_path'],
+                    file_data['current_dest_id'], lambda dest_id: my_drive.upload_file(dest_id,
+                        file_data['full_file_path'], progress_callback=callback, check_exists=False,
+                        replace=file_data['replace']))
+                if file_data['content']:
+                    with shared_data['lock']: # later duplicates can be copied from it
+                        remote_contents.setdefault(file_data['content'], file_id)
             else:
                 debug_pretend_upload(file_data['full_file_path'], callback)
                 
@@ -260,26 +538,94 @@ def main(source_root, dest_root, options):
                 shared_data['num_processed_files'] += 1
                 shared_data['error_streak'] += 1
 
+    # Upload a pack: the archive is made while it's uploaded, then its index
+    def upload_pack_task(data):
+        shared_data = data['shared_data']
+        file_data = data['file_data']
+        tid = Worker.current_thread_id()
+        my_drive = g_thread_data[tid]['drive']
+        num_files = len(file_data['pack'])
+        try:
+            # The archive is a bit bigger than its files, close enough for the bar
+            callback = lambda progress, total, chunk_size=None: (g_progress_bar.update_part(tid,
+                min(progress, file_data['file_size']), file_data['file_size']),
+                g_progress_bar.update_total(shared_data['num_processed_files'], num_source_files))
+            if not DEBUG_DRY_RUN:
+                def upload_archive(dest_id): # a new archive on each attempt
+                    writer = PackWriter([ (packed['file'], packed['full_file_path'])
+                        for packed in file_data['pack'] ])
+                    return writer, my_drive.upload_stream(dest_id, file_data['file'] + PACK_SUFFIX,
+                        writer.stream(), progress_callback=callback)
+                (writer, archive_id), file_data['current_dest_id'] = my_drive.run_in_folder(
+                    file_data['dest_path'], file_data['current_dest_id'], upload_archive)
+                # The index makes the files count as uploaded, only write it
+                # for an archive that's all there
+                if my_drive.get_content_info(archive_id) != (writer.size, writer.md5.hexdigest()):
+                    my_drive.delete_file(archive_id)
+                    raise IOError('the archive on the Drive differs from the one made')
+                my_drive.upload_stream(file_data['current_dest_id'], file_data['file'] + PACK_INDEX_SUFFIX,
+                    [ writer.index_content(archive_id) ])
+                num_packed = len(writer.index['files'])
+            else:
+                num_packed = num_files
+
+            with shared_data['lock']:
+                shared_data['size_uploaded_files'] += file_data['file_size']
+                shared_data['num_uploaded_files'] += num_packed
+                shared_data['num_upload_errors'] += num_files - num_packed
+                shared_data['num_processed_files'] += num_files
+                shared_data['num_packs'] += 1
+                shared_data['error_streak'] = 0
+        except Exception as e:
+            print('**Pack upload error: ' + str(e))
+            with shared_data['lock']:
+                shared_data['num_upload_errors'] += num_files
+                shared_data['num_processed_files'] += num_files
+                shared_data['error_streak'] += 1
+
+    def submit_upload(file_data):
+        data = { 'shared_data': shared_data, 'file_data': file_data }
+        if MAX_CONCURRENT_UPLOADS > 1:
+            queue.submit(data, file_data['file_size']) # waits while the queue is full
+        else:
+            upload_task(data)
+
+    # Queue the small files of a directory as a pack (or as they are if few)
+    def submit_pack(pack, dest_path, dest_id):
+        if len(pack) < PACK_MIN_FILES:
+            for file_data in pack:
+                submit_upload(file_data)
+            return
+        submit_upload({
+            'dest_path': dest_path,
+            'current_dest_id': dest_id,
+            'file': make_pack_name(),
+            'file_size': sum([ file_data['file_size'] for file_data in pack ]),
+            'copy_from': None,
+            'pack': pack,
+        })
+
     # Prepare and start worker threads
     for i in range(MAX_CONCURRENT_UPLOADS):
         g_thread_data.append({ 'drive': drive.duplicate_service() })
-    queue = Dispatcher(MAX_CONCURRENT_UPLOADS, 2*MAX_CONCURRENT_UPLOADS, upload_task)
+    queue_size = 2*MAX_CONCURRENT_UPLOADS if options['schedule'] == SCHEDULE_FIFO else SCHEDULE_LOOKAHEAD
+    queue = Dispatcher(MAX_CONCURRENT_UPLOADS, queue_size, upload_task, policy=options['schedule'])
     queue.start()
     
     # Walk each subdir in source (including the root)
     start_time = time.time()
-    for path, dirs, files in os.walk(source_root):
-        if check_dir_excluded(path, options, root=source_root):
-            print('Directory "%s" excluded from upload' % path)
-            continue
-                
-        # Calculate the destination path for this directory in the Drive and
-        # obtain the list of files that already exist there (as a hash map)
-        relative_path = make_relative_path(path, source_root)
-        dest_path = clean_path(dest_root + '/' + relative_path)
-        current_dest_id = drive.ensure_path(dest_path)
-        print('Listing files for "%s"...' % dest_path)
-        existing_files_map = result_list_to_map(drive.list_files(current_dest_id))
+    for dir in walk_prepared_dirs(drive, source_root, dest_root, dest_root_id, options, hasher):
+        # The destination path for this directory in the Drive and the list of
+        # files that already exist there (as a hash map)
+        path = dir['path']
+        files = dir['files']
+        relative_path = dir['relative_path']
+        dest_path = dir['dest_path']
+        current_dest_id = dir['dest_id']
+        existing_files_map = dir['existing_files_map']
+        changed_files_map = dir['changed_files_map']
+        pack = [] # small files to upload together (pack mode)
+        pack_size = 0
         
         # Walk each file in this subdir
         for file in files:
@@ -300,31 +646,35 @@ def main(source_root, dest_root, options):
                         shared_data['num_skipped_files'] += 1
                         shared_data['num_processed_files'] += 1
                 else:
-                    data = {
-                        'shared_data': shared_data,
-                        'file_data': {
-                            'dest_path': dest_path,
-                            'current_dest_id': current_dest_id,
-                            'file': file,
-                            'full_file_path': full_file_path,
-                            'file_size': file_size,
-                        },
+                    content = dir['hashes'].get(full_file_path)
+                    with shared_data['lock']:
+                        copy_from = remote_contents.get(content) if options['copy_duplicates'] else None
+                    file_data = {
+                        'dest_path': dest_path,
+                        'current_dest_id': current_dest_id,
+                        'file': file,
+                        'full_file_path': full_file_path,
+                        'file_size': file_size,
+                        'replace': options['replace'] or file in changed_files_map,
+                        'content': content,
+                        'copy_from': copy_from,
+                        'pack': None,
                     }
-                    if MAX_CONCURRENT_UPLOADS > 1:
-                        while True:
-                            if queue.add_data(data):
-                                break
-                            else:
-                                time.sleep(0.1)
+                    if options['pack'] and file_size <= PACK_FILE_MAX_SIZE and not copy_from \
+                            and not file_data['replace']:
+                        pack.append(file_data)
+                        pack_size += file_size
+                        if len(pack) >= PACK_MAX_FILES or pack_size >= PACK_MAX_SIZE:
+                            submit_pack(pack, dest_path, current_dest_id)
+                            pack = []
+                            pack_size = 0
                     else:
-                        upload_task(data)
+                        submit_upload(file_data)
                         
                     # Error handling
                     if shared_data['error_streak'] >= ERROR_STREAK_ABORT:
+                        print('Too many sequential errors, aborting...')
                         g_stop_loop = True
-                    elif shared_data['error_streak'] >= ERROR_STREAK_WAIT:
-                        print('Too many sequential errors, waiting 30 seconds before continuing...')
-                        time.sleep(30)
             else:
                 # File already exists in destination
                 with shared_data['lock']:
@@ -334,17 +684,17 @@ def main(source_root, dest_root, options):
             if g_stop_loop:
                 queue.clear_data()
                 break # for file
+        if len(pack) > 0 and not g_stop_loop:
+            submit_pack(pack, dest_path, current_dest_id)
         if g_stop_loop:
             queue.clear_data()
             break # for path
 
-    # Wait for the queue to become empty and the workers idle
-    while True:
-        if queue.has_data() or queue.is_busy():
-            time.sleep(1)
-        else:
-            break
+    # Wait for the queued uploads to finish
+    queue.join()
     queue.stop()
+    if hasher:
+        hasher.close()
 
     end_time = time.time()
     elapsed_time = end_time - start_time
@@ -363,17 +713,95 @@ def main(source_root, dest_root, options):
     print('%d file(s) uploaded (%s)' % (
         shared_data['num_uploaded_files'],
         format_pretty_size(shared_data['size_uploaded_files'])))
+    if shared_data['num_packs'] > 0:
+        print('%d pack(s) uploaded' % shared_data['num_packs'])
+    if shared_data['num_copied_files'] > 0:
+        print('%d file(s) copied from duplicates on the Drive' % shared_data['num_copied_files'])
     print('%d file(s) failed to upload' % shared_data['num_upload_errors'])
     if shared_data['num_skipped_files'] > 0:
         print('%d file(s) skipped' % shared_data['num_skipped_files'])
     print('%d file(s) already existed' % shared_data['num_existing_files'])
     print('')
 
+"""
+Upload what comes through the standard input as a file in the destination path,
+with no temp file (see --stdin).
+"""
+def main_stdin(file_name, dest_root, options):
+    secret_file = get_client_secret_file()
+    if not secret_file:
+        print('No client secret file found!')
+        sys.exit(1)
+    from drive import Drive
+    from metadata_cache import MetadataCache
+    print('Connecting to Google Drive... ', end='')
+    cache = MetadataCache(METADATA_CACHE_FILE, METADATA_CACHE_MAX_AGE) if options['cache'] else None
+    drive = Drive(cache=cache)
+    drive.connect(secret_file)
+    print('CONNECTED')
+    profile_mark('connected')
+    if cache:
+        print('Refreshing the metadata cache... ', end='')
+        print('%d change(s)' % drive.refresh_cache())
+
+    dest_root_id = drive.get_path(dest_root)
+    if not dest_root_id:
+        print('ERROR: path "%s" not found in your Drive' % dest_root)
+        sys.exit(1)
+    profile_mark('destination found')
+
+    print('Uploading the standard input to "%s/%s"' % (clean_path(dest_root), file_name))
+    progress_bar = ProgressBar(1)
+    progress_bar.start()
+    size_read = [ 0 ]
+    def read_stdin():
+        while True:
+            data = sys.stdin.buffer.read(STDIN_READ_SIZE)
+            if not data:
+                return
+            size_read[0] += len(data)
+            yield data
+    callback = lambda progress, total, chunk_size=None: (progress_bar.update_part(0, progress, total),
+        progress_bar.update_total(0, 1))
+    start_time = time.time()
+    try:
+        drive.upload_stream(dest_root_id, file_name, read_stdin(), progress_callback=callback)
+    finally:
+        progress_bar.stop()
+        progress_bar.clear()
+    elapsed_time = time.time() - start_time
+
+    print('\n--Operation completed--')
+    print('Time taken: ' + format_pretty_time(elapsed_time))
+    print('Average upload speed:  %s/s' % format_pretty_size(size_read[0] / elapsed_time))
+    print('1 file(s) uploaded (%s)' % format_pretty_size(size_read[0]))
+    print('')
+
 USAGE = """
 python upload.py [OPTIONS] [--source SOURCE_ROOT] [--dest DEST_ROOT]
+python upload.py [OPTIONS] --stdin FILE_NAME [--dest DEST_ROOT]
   Options:
     --ask-source Ask for source (even if source is specified).
     --ask-dest Ask for destination (even if dest is specified).
+    --async Prepare the destination directories concurrently (needs aiohttp).
+    --schedule POLICY Order in which the queued files are uploaded: 'fifo' (as
+found, default), 'largest' first (shortens the tail of the run) or 'mixed'
+(largest and smallest alternated). Files waiting too long go next anyway.
+    --checksum Compare files by content (MD5) instead of by name: files already
+in the destination under any name are skipped, changed files are replaced.
+    --copy-duplicates Files whose content (MD5) is already somewhere in the
+destination are copied there on the Drive instead of uploaded. Whether a file
+exists is still decided by name (or, with --checksum, by content). It hashes
+all the local files and lists every file under the destination at first.
+    --pack Upload the small files (up to 100 KB) of each directory bundled in
+archives ("packs", tar), each with an index file of what's in it and where.
+Much faster for lots of tiny files.
+    --cache Keep a local cache of Drive folders and files, so they aren't
+listed again on later runs. It's brought up to date from the Drive's changes
+at the start of each run.
+    --profile-startup Report how long each startup phase took, on exit.
+  --stdin FILE_NAME Upload the standard input (e.g. a pipe from a dump or tar)
+as a file with this name in DEST, instead of a directory.
   --source SOURCE_ROOT Source directory from which all contents will be
 uploaded. The root directory itself will not be copied.
   --dest DEST_ROOT Destination path on the Drive inside of which SOURCE's
@@ -384,17 +812,28 @@ if __name__ == '__main__':
     parser.add_argument('--ask-source', action='store_true', default=False)
     parser.add_argument('--ask-dest', action='store_true', default=False)
     parser.add_argument('--source')
+    parser.add_argument('--stdin')
     parser.add_argument('--dest')
     parser.add_argument('--exclude-dir-part')
     parser.add_argument('--max-size')
     parser.add_argument('--skip-confirmation', action='store_true', default=False)
     parser.add_argument('--replace', action='store_true', default=False)
+    parser.add_argument('--cache', action='store_true', default=False)
+    parser.add_argument('--async', dest='use_async', action='store_true', default=False)
+    parser.add_argument('--checksum', action='store_true', default=False)
+    parser.add_argument('--copy-duplicates', action='store_true', default=False)
+    parser.add_argument('--pack', action='store_true', default=False)
+    parser.add_argument('--schedule', choices=SCHEDULE_POLICIES, default=SCHEDULE_FIFO)
+    parser.add_argument('--profile-startup', action='store_true', default=False)
     args = parser.parse_args()
+    if args.profile_startup:
+        profile_startup()
+        profile_mark('arguments parsed')
 
-    if args.ask_source or not args.source:
+    if not args.stdin and (args.ask_source or not args.source):
         args.source = ask_for_source(args.source)
     
-    if not args.source:
+    if not args.stdin and not args.source:
         print('No source selected')
         sys.exit(1)
         
@@ -405,4 +844,7 @@ if __name__ == '__main__':
         print('No destination specified')
         sys.exit(1)
         
-    main(args.source, args.dest, { 'max_size': process_human_size(args.max_size), 'skip_confirmation': args.skip_confirmation, 'exclude_dir': args.exclude_dir_part, 'replace' : args.replace })
+    if args.stdin:
+        main_stdin(args.stdin, args.dest, { 'cache': args.cache })
+    else:
+        main(args.source, args.dest, { 'max_size': process_human_size(args.max_size), 'skip_confirmation': args.skip_confirmation, 'exclude_dir': args.exclude_dir_part, 'replace' : args.replace, 'cache': args.cache, 'async': args.use_async, 'schedule': args.schedule, 'checksum': args.checksum, 'copy_duplicates': args.copy_duplicates, 'pack': args.pack })
@@ -0,0 +1,79 @@
+"""
+Raphael Pithan
+2021
+"""
+
+import os
+import os.path
+import json
+import threading
+import time
+
+SESSION_MAX_AGE = 6 * 24 * 60 * 60 # seconds (Drive keeps sessions for a week)
+SAVE_INTERVAL = 30 # seconds between saves for progress only (the server knows it anyway)
+
+"""
+Persistent journal of the resumable upload sessions in progress, so an upload
+interrupted by a crash or Ctrl+C can continue where it stopped on a later run.
+Sessions are keyed by the local file (path, size, mtime) and the destination
+directory id. Thread-safe, the same instance can be shared among Drive instances.
+"""
+class UploadJournal:
+    def __init__(self, journal_file):
+        dir = os.path.split(journal_file)[0]
+        if dir:
+            os.makedirs(dir, exist_ok=True)
+        self.journal_file = journal_file
+        self.lock = threading.Lock()
+        self.save_time = 0
+        self.sessions = {}
+        try:
+            with open(journal_file, 'rt') as f:
+                self.sessions = json.load(f)
+        except (OSError, ValueError):
+            pass
+        min_time = time.time() - SESSION_MAX_AGE
+        self.sessions = { k: v for k, v in self.sessions.items() if v['time'] >= min_time }
+
+    """
+    Make the key of an upload.
+    """
+    def make_key(self, full_file_path, parent_id):
+        stat = os.stat(full_file_path)
+        return '|'.join([ os.path.abspath(full_file_path), str(stat.st_size),
+            str(stat.st_mtime_ns), parent_id ])
+
+    """
+    Get the session of an upload as a dict with 'uri' and 'progress' (or None).
+    """
+    def get(self, key):
+        with self.lock:
+            return self.sessions.get(key)
+
+    """
+    Record the session URI of an upload and its last confirmed byte offset. New
+    sessions are saved at once, progress only every SAVE_INTERVAL seconds: a
+    resumed upload asks the server where to continue.
+    """
+    def set(self, key, uri, progress):
+        with self.lock:
+            session = self.sessions.get(key)
+            is_new = not session or session['uri'] != uri
+            if is_new:
+                session = { 'uri': uri, 'time': time.time() }
+                self.sessions[key] = session
+            session['progress'] = progress
+            if is_new or time.monotonic() - self.save_time >= SAVE_INTERVAL:
+                self._save()
+
+    def remove(self, key):
+        with self.lock:
+            if self.sessions.pop(key, None):
+                self._save()
+
+    def _save(self):
+        self.save_time = time.monotonic()
+        temp_file = self.journal_file + '.tmp'
+        with open(temp_file, 'wt') as f:
+            json.dump(self.sessions, f)
+        os.replace(temp_file, self.journal_file)
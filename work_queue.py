@@ -1,6 +1,7 @@
 import time
 import threading
 import traceback
+from concurrent.futures import Future
 
 def __debug(str):
     print(threading.current_thread().name + ': ' + str)
@@ -13,13 +14,24 @@ def _debug_locks(str):
     #__debug(str)
     pass
 
+# Scheduling policies: which queued task runs next
+SCHEDULE_FIFO = 'fifo'          # in queuing order
+SCHEDULE_LARGEST = 'largest'    # largest first (among the queued ones)
+SCHEDULE_MIXED = 'mixed'        # alternates largest and smallest
+SCHEDULE_POLICIES = [ SCHEDULE_FIFO, SCHEDULE_LARGEST, SCHEDULE_MIXED ]
+SCHEDULE_MAX_SKIPS = 32 # times a task can be passed over before it's picked anyway
+
 
 """
-Main class. Dispatcher for queued tasks.
+Main class. Dispatcher for queued tasks. With a policy other than FIFO, the
+queue works as a lookahead window: tasks are picked by their size (e.g. bytes
+to upload), so long tasks start early instead of becoming the tail of the run.
+A task passed over SCHEDULE_MAX_SKIPS times is picked next, so none waits for
+long.
 """
 class Dispatcher:
-    def __init__(self, num_workers, queue_size, task_func):
-        self.queue = Queue(queue_size)
+    def __init__(self, num_workers, queue_size, task_func, policy=SCHEDULE_FIFO):
+        self.queue = Queue(queue_size, policy)
         self.num_workers = num_workers
         self.workers = [ None ] * num_workers
         for i in range(num_workers):
@@ -36,8 +48,28 @@ class Dispatcher:
         for w in self.workers:
             w.stop(True)
     
-    def add_data(self, data):
-        return self.queue.add_data(data)
+    """
+    Queue a task, waiting while the queue is full. The size is used by the
+    scheduling policy.
+    Returns a concurrent.futures.Future with the task's result or exception
+    (whose traceback is printed too, as for add_data), cancelled if the
+    dispatcher was stopped before the task could be queued.
+    """
+    def submit(self, data, size=0):
+        future = Future()
+        if not self.queue.put((data, future), size):
+            future.cancel()
+        return future
+    
+    """
+    Wait until every queued task is done (or the timeout, in seconds, expires).
+    Returns True if all tasks are done.
+    """
+    def join(self, timeout=None):
+        return self.queue.join(timeout)
+    
+    def add_data(self, data, size=0):
+        return self.queue.add_data((data, None), size)
     
     def has_data(self):
         return self.queue.has_data()
@@ -49,10 +81,7 @@ class Dispatcher:
         return self.queue.is_full()
     
     def is_busy(self):
-        for w in self.workers:
-            if w.is_busy():
-                return True
-        return False
+        return self.queue.num_running() > 0
 
 
 """
@@ -89,91 +118,136 @@ class Worker:
     def _thread_entry(self):
         _debug_w('thread started')
         while self.run:
+            item = self.queue.get_data()
+            if item is None:
+                continue # released
+            data, future = item
+            self.busy = True
             try:
-                data = self.queue.get_data(1000)
-                if data != None:
+                if future is None:
                     _debug_w('thread is busy')
-                    self.busy = True
                     self.task(data)
-                else:
-                    _debug_w('thread is idle')
-                    self.busy = False
+                elif future.set_running_or_notify_cancel():
+                    _debug_w('thread is busy')
+                    future.set_result(self.task(data))
             except BaseException as e:
-                print(traceback.format_exc())
+                print(traceback.format_exc()) # even with a future, which may not be read
+                if future is not None:
+                    future.set_exception(e)
+            finally:
+                _debug_w('thread is idle')
+                self.busy = False
+                self.queue.task_done()
         _debug_w('thread ended')
 
 
 """
-Inner class. Thread-safe fixed length circular queue for task distribution
-between workers.
+Inner class. Thread-safe fixed length queue for task distribution between
+workers, which picks the next task according to the scheduling policy.
+Consumers block until there is data, producers can block until there is room,
+and join() waits until every task is done.
 """
 class Queue:
-    def __init__(self, size):
+    def __init__(self, size, policy=SCHEDULE_FIFO):
         self.size = size
-        self.queue = [ None ] * size
-        self.head = 0
-        self.tail = 0
+        self.policy = policy
+        self.queue = [] # of [data, size, times passed over]
+        self.pick_smallest = False # alternates on mixed policy
+        self.unfinished = 0 # queued or running
+        self.released = False
         self.general_lock = threading.Lock()
-        self.empty_lock = threading.Lock()
-        self.empty_lock.acquire(blocking=False) # starts empty
-        _debug_locks('##EMPTY LOCK ACQUIRED##$INIT')
+        self.not_empty = threading.Condition(self.general_lock)
+        self.not_full = threading.Condition(self.general_lock)
+        self.all_done = threading.Condition(self.general_lock)
 
-    def add_data(self, data):
+    def _push(self, data, size):
+        self.queue.append([data, size, 0])
+        self.unfinished += 1
+        self.not_empty.notify()
+    
+    def _pop(self):
+        i = 0
+        if self.policy != SCHEDULE_FIFO and self.queue[0][2] < SCHEDULE_MAX_SKIPS:
+            sizes = [ entry[1] for entry in self.queue ]
+            if self.pick_smallest:
+                i = sizes.index(min(sizes))
+            else:
+                i = sizes.index(max(sizes))
+            self.pick_smallest = self.policy == SCHEDULE_MIXED and not self.pick_smallest
+        for entry in self.queue[:i]: # the oldest are first
+            entry[2] += 1
+        return self.queue.pop(i)[0]
+    
+    def add_data(self, data, size=0):
         with self.general_lock:
             if not self.is_full():
-                was_empty = not self.has_data()
-                self.queue[self.tail] = data
-                self.tail = (self.tail + 1) % self.size
-                if self.tail == self.head:
-                    self.tail = Queue.FULL
-                if was_empty:
-                    _debug_locks('##EMPTY LOCK RELEASED##$ADD')
-                    self.empty_lock.release()
+                self._push(data, size)
                 return True
             else: # full queue
                 return False
     
-    def get_data(self, timeout):
-        if self.empty_lock.acquire(timeout=timeout/1000): # proceeds if/when not empty
-            _debug_locks('##EMPTY LOCK ACQUIRED##$GET')
-            try:
-                with self.general_lock:
-                    if self.has_data():
-                        if self.is_full():
-                            self.tail = self.head
-                        data = self.queue[self.head]
-                        self.queue[self.head] = None
-                        self.head = (self.head + 1) % self.size
-                        if self.has_data(): # didn't become empty
-                            _debug_locks('##EMPTY LOCK RELEASED##$GET/1')
-                            self.empty_lock.release()
-                        return data
-                    else: # empty queue
-                        _debug_locks('##EMPTY LOCK RELEASED##$GET/2')
-                        self.empty_lock.release()
-            except:
-                _debug_locks('##EMPTY LOCK RELEASED##$GET/EXCEPTION')
-                self.empty_lock.release()
-        return None
+    """
+    Add data, waiting while the queue is full (or the timeout, in seconds,
+    expires). Returns True if added.
+    """
+    def put(self, data, size=0, timeout=None):
+        with self.not_full:
+            if not self.not_full.wait_for(lambda: not self.is_full() or self.released, timeout):
+                return False
+            if self.is_full():
+                return False
+            self._push(data, size)
+            return True
+    
+    """
+    Get data, waiting while the queue is empty (or the timeout, in seconds,
+    expires). Returns None on timeout or release.
+    """
+    def get_data(self, timeout=None):
+        with self.not_empty:
+            self.not_empty.wait_for(lambda: self.has_data() or self.released, timeout)
+            if not self.has_data():
+                return None
+            data = self._pop()
+            self.not_full.notify()
+            return data
+    
+    """
+    Mark a task got through get_data as done.
+    """
+    def task_done(self):
+        with self.general_lock:
+            self.unfinished -= 1
+            if self.unfinished == 0:
+                self.all_done.notify_all()
+    
+    def join(self, timeout=None):
+        with self.all_done:
+            return self.all_done.wait_for(lambda: self.unfinished == 0, timeout)
     
     def clear(self):
         with self.general_lock:
-            self.head = self.tail
+            for (data, future), size, skips in self.queue:
+                if future is not None:
+                    future.cancel()
+            self.unfinished -= len(self.queue)
+            self.queue = []
+            if self.unfinished == 0:
+                self.all_done.notify_all()
+            self.not_full.notify_all()
     
     def release_all(self):
-        try:
-            self.general_lock.acquire(timeout=3000)
-            while self.empty_lock.locked():
-                self.empty_lock.release()
-            while self.general_lock.locked():
-                self.general_lock.release()
-        except:
-            pass
+        with self.general_lock:
+            self.released = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+    
+    def num_running(self):
+        with self.general_lock:
+            return self.unfinished - len(self.queue)
     
-    FULL = -1
-
     def has_data(self):
-        return self.tail != self.head
+        return len(self.queue) > 0
 
     def is_full(self):
-        return self.tail == Queue.FULL
+        return len(self.queue) >= self.size